@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+"""Measure how formatflowed throughput scales with threads
+
+Decodes, re-encodes and wraps a corpus of generated messages using a single
+decoder and encoder shared by all threads of a ThreadPoolExecutor, for an
+increasing number of worker threads. On a free-threaded CPython build (3.13t
+or newer, running with the GIL disabled) throughput should grow with the
+number of cores; with the GIL it stays flat.
+
+Usage:
+
+  python benchmarks/thread_scaling.py [--messages N] [--size BYTES]
+                                      [--max-workers N] [--repeat N]
+
+Requires Python 3.2 or newer.
+
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from formatflowed import (  # noqa: E402
+    FIXED, PARAGRAPH, DecoderOptions, EncoderOptions, FormatFlowedDecoder,
+    FormatFlowedEncoder, convertToWrapped)
+
+
+WORDS = ('the', 'March', 'Hare', 'said', 'to', 'Alice', 'very', 'earnestly',
+         'take', 'some', 'more', 'tea', 'nothing', 'yet', 'Hatter')
+
+
+def make_message(size, rng):
+    """Generate a flowed message of roughly size bytes"""
+    encoder = FormatFlowedEncoder(width=72)
+    chunks = []
+    total = 0
+    while total < size:
+        quotedepth = rng.choice((0, 0, 1, 2))
+        text = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(5, 80)))
+        chunks.append(({'type': PARAGRAPH, 'quotedepth': quotedepth}, text))
+        chunks.append(({'type': FIXED, 'quotedepth': quotedepth}, ''))
+        total += len(text)
+    return encoder.encode(chunks)
+
+
+def process(decoder, encoder, message):
+    """The per-message workload: round trip the text and wrap it"""
+    chunks = list(decoder.decode(message))
+    encoder.encode(chunks)
+    convertToWrapped(message, width=60, options=decoder.getOptions())
+    return len(message)
+
+
+def run(messages, workers, repeat):
+    decoder = FormatFlowedDecoder(options=DecoderOptions())
+    encoder = FormatFlowedEncoder(options=EncoderOptions(width=60))
+    best = None
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            total = sum(executor.map(
+                lambda message: process(decoder, encoder, message),
+                messages))
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+    return total / best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=400)
+    parser.add_argument('--size', type=int, default=8192)
+    parser.add_argument('--max-workers', type=int, default=os.cpu_count())
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    rng = random.Random(3676)
+    messages = [make_message(args.size, rng) for _ in range(args.messages)]
+    is_gil_enabled = getattr(sys, '_is_gil_enabled', lambda: True)
+    print('Python %s, GIL %s, %d CPUs' % (
+        sys.version.split()[0],
+        'enabled' if is_gil_enabled() else 'disabled', os.cpu_count()))
+
+    workers, baseline = 1, None
+    while workers <= args.max_workers:
+        throughput = run(messages, workers, args.repeat)
+        baseline = baseline or throughput
+        print('%3d threads: %8.2f MB/s  (%.2fx)' % (
+            workers, throughput / 1e6, throughput / baseline))
+        workers *= 2
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+"""Compare decoding flowed text line by line and with NumPy
+
+Decodes generated messages of flowed paragraphs, quoted paragraphs, log
+lines and UTF-8 text, once line by line and once as FormatFlowedDecoder
+does with NumPy installed, checking that both produce the same chunks.
+Texts smaller than the NumPy window size are always decoded line by line,
+so make the messages larger than that.
+
+Usage:
+
+  python benchmarks/vector_decode.py [--size BYTES] [--repeat N]
+
+Requires NumPy.
+
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from formatflowed import (  # noqa: E402
+    FIXED, PARAGRAPH, DecoderOptions, FormatFlowedDecoder,
+    FormatFlowedEncoder)
+
+
+WORDS = ('the', 'March', 'Hare', 'said', 'to', 'Alice', 'very', 'earnestly',
+         'take', 'some', 'more', 'tea', 'nothing', 'yet', 'Hatter',
+         'caf\xe9', 'na\xefve')
+
+
+def make_message(size, rng, quotedepths=(0,), fixed=False,
+                 character_set='us-ascii'):
+    """Generate a flowed message of roughly size bytes"""
+    encoder = FormatFlowedEncoder(width=72, character_set=character_set)
+    words = WORDS if character_set == 'utf-8' else WORDS[:-2]
+    chunks = []
+    total = 0
+    while total < size:
+        quotedepth = rng.choice(quotedepths)
+        if fixed:
+            text = '2016-01-01 12:00:%02d INFO request took %d ms' % (
+                rng.randint(0, 59), rng.randint(1, 999))
+            chunks.append(({'type': FIXED, 'quotedepth': quotedepth}, text))
+        else:
+            text = ' '.join(rng.choice(words)
+                            for _ in range(rng.randint(5, 80)))
+            chunks.append(({'type': PARAGRAPH, 'quotedepth': quotedepth},
+                           text))
+            chunks.append(({'type': FIXED, 'quotedepth': quotedepth}, ''))
+        total += len(text)
+    return encoder.encode(chunks)
+
+
+def best_of(func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=1 << 20)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    rng = random.Random(3676)
+    corpus = (
+        ('paragraphs', make_message(args.size, rng), 'us-ascii'),
+        ('quoted', make_message(args.size, rng, (1, 2, 3)), 'us-ascii'),
+        ('log lines', make_message(args.size, rng, fixed=True), 'us-ascii'),
+        ('UTF-8', make_message(args.size, rng, character_set='utf-8'),
+         'utf-8'),
+    )
+    print('Python %s, NumPy %s, %d byte messages' % (
+        sys.version.split()[0], numpy.__version__, args.size))
+    for name, message, character_set in corpus:
+        for coalesce_fixed in (False, True):
+            options = DecoderOptions(character_set=character_set,
+                                     coalesce_fixed=coalesce_fixed)
+            decoder = FormatFlowedDecoder(options=options)
+
+            def lines():
+                return list(decoder._assemble(
+                    decoder._scanLines(message, options), options))
+
+            def vectorized():
+                return list(decoder.decode(message))
+
+            assert lines() == vectorized()
+            line_time = best_of(lines, args.repeat)
+            vector_time = best_of(vectorized, args.repeat)
+            print('%-10s %-15s line by line %7.2f MB/s, NumPy %7.2f MB/s '
+                  '(%.2fx)' % (
+                      name, 'coalesce_fixed' if coalesce_fixed else '',
+                      len(message) / line_time / 1e6,
+                      len(message) / vector_time / 1e6,
+                      line_time / vector_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -3,6 +3,10 @@
 This module provides an API to create and display text/plain; format=flowed
 mimetype text.
 
+The module keeps no global mutable state, and all its functions and classes
+can be used from multiple threads at once; see FormatFlowedDecoder and
+FormatFlowedEncoder for the details on sharing instances.
+
 """
 
 # Copyright (C) 2005-2016 Martijn Pieters
@@ -13,19 +17,37 @@ mimetype text.
 
 from __future__ import unicode_literals
 
+import codecs
 import re
 import textwrap
+from array import array
+from bisect import bisect_right
+from collections import namedtuple
+from itertools import chain
+
+try:
+    import numpy
+except ImportError:  # NumPy is optional, see _vectorChunks
+    numpy = None
 
 __all__ = [
     'PARAGRAPH',
     'FIXED',
     'SIGNATURE_SEPARATOR',
+    'DecoderOptions',
+    'EncoderOptions',
     'FormatFlowedDecoder',
     'FormatFlowedEncoder',
+    'FormatFlowedEncoderSession',
+    'FormatFlowedDocument',
     'decode',
     'encode',
+    'reflow',
+    'scan',
+    'iterTokens',
     'convertToWrapped',
-    'convertToFlowed'
+    'convertToFlowed',
+    'convertToHTML'
 ]
 
 # Constants denoting the various text chunk types recognized by format=flowed
@@ -35,6 +57,54 @@ PARAGRAPH, FIXED, SIGNATURE_SEPARATOR = range(3)
 # -- Public classes ----------------------------------------------------
 
 
+class DecoderOptions(namedtuple(str('DecoderOptions'), str(
+        'delete_space character_set error_handling max_paragraph_chars '
+        'coalesce_fixed'))):
+    """Immutable set of FormatFlowedDecoder options
+
+    Takes the same arguments, with the same defaults, as FormatFlowedDecoder.
+    Options objects can't be altered, so they can be shared freely between
+    decoders and threads; use _replace to derive variations:
+
+        >>> options = DecoderOptions(character_set='utf-8')
+        >>> options.character_set == 'utf-8', options.delete_space
+        (True, False)
+        >>> options._replace(delete_space=True).delete_space
+        True
+
+    """
+    __slots__ = ()
+
+    def __new__(cls, delete_space=False, character_set='us-ascii',
+                error_handling='strict', max_paragraph_chars=None,
+                coalesce_fixed=False):
+        return super(DecoderOptions, cls).__new__(
+            cls, delete_space, character_set, error_handling,
+            max_paragraph_chars, coalesce_fixed)
+
+
+class EncoderOptions(namedtuple(str('EncoderOptions'), str(
+        'extra_space character_set error_handling spacestuff_quoted '
+        'width'))):
+    """Immutable set of FormatFlowedEncoder options
+
+    Takes the same arguments, with the same defaults, as FormatFlowedEncoder,
+    and like DecoderOptions can be shared freely:
+
+        >>> options = EncoderOptions(width=45)
+        >>> options.width, options.spacestuff_quoted
+        (45, True)
+
+    """
+    __slots__ = ()
+
+    def __new__(cls, extra_space=False, character_set='us-ascii',
+                error_handling='strict', spacestuff_quoted=True, width=78):
+        return super(EncoderOptions, cls).__new__(
+            cls, extra_space, character_set, error_handling,
+            spacestuff_quoted, width)
+
+
 class FormatFlowedDecoder:
     """Object for converting a format=flowed bytestring to other formats
 
@@ -49,13 +119,41 @@ class FormatFlowedDecoder:
         encoding, using the error handling scheme specified below.
       error_handling (default: strict)
         The error handling scheme used when decoding the text.
+      max_paragraph_chars (default: None)
+        The maximum number of characters to collect into a single paragraph
+        chunk. Longer paragraphs are emitted in parts, see the 'continued'
+        flag documented for the decode method. None means no limit.
+      coalesce_fixed (default: False)
+        Combine consecutive fixed lines at the same quotedepth into a single
+        FIXED block chunk, see the 'block' flag documented for the decode
+        method. Text with many fixed lines, such as source code or logs, then
+        decodes to far fewer chunks.
+
+    Alternatively, pass in a DecoderOptions object as options; the other
+    arguments are then ignored.
+
+    Decoders can be shared between threads. decode takes a snapshot of the
+    attributes when called and keeps no other state, so changing an
+    attribute only affects later calls, never a decode in progress:
+
+        >>> decoder = FormatFlowedDecoder(options=DecoderOptions(
+        ...     delete_space=True))
+        >>> chunks = decoder.decode(b'flowed \\r\\ntext')
+        >>> decoder.delete_space = False
+        >>> list(chunks) == [({'type': PARAGRAPH, 'quotedepth': 0},
+        ...                   'flowedtext')]
+        True
 
     """
     def __init__(self, delete_space=False, character_set='us-ascii',
-                 error_handling='strict'):
-        self.delete_space = delete_space
-        self.character_set = character_set
-        self.error_handling = error_handling
+                 error_handling='strict', max_paragraph_chars=None,
+                 coalesce_fixed=False, options=None):
+        if options is None:
+            options = DecoderOptions(delete_space, character_set,
+                                     error_handling, max_paragraph_chars,
+                                     coalesce_fixed)
+        (self.delete_space, self.character_set, self.error_handling,
+         self.max_paragraph_chars, self.coalesce_fixed) = options
 
     # -- Private methods -----------------------------------------------
 
@@ -136,8 +234,152 @@ class FormatFlowedDecoder:
             return line[:-1]
         return line
 
+    def _scanLines(self, flowed, options):
+        """Classify the lines of flowed text one by one
+
+        Yields a (quotedepth, type, line) tuple per line, where type is one
+        of PARAGRAPH (for flowed lines), FIXED or SIGNATURE_SEPARATOR. The
+        line is stripped of quotemarks, stuffing and, if delete_space is set
+        in the options, the flow space:
+
+            >>> decoder = FormatFlowedDecoder()
+            >>> options = DecoderOptions(delete_space=True)
+            >>> flowed = b'>> flowed \\r\\n> -- \\r\\n '
+            >>> list(decoder._scanLines(flowed, options)) == [
+            ...     (2, PARAGRAPH, 'flowed'), (1, SIGNATURE_SEPARATOR, '-- '),
+            ...     (0, FIXED, '')]
+            True
+
+        """
+        character_set, error_handling = (options.character_set,
+                                         options.error_handling)
+        delete_space = options.delete_space
+        for line in _splitlines(flowed):
+            line = line.decode(character_set, error_handling)
+            quotedepth, line = self._stripquotes(line)
+            line = self._stripstuffing(line)
+            if line == '-- ':
+                yield quotedepth, SIGNATURE_SEPARATOR, line
+            elif line.endswith(' '):
+                if delete_space:
+                    line = line[:-1]
+                yield quotedepth, PARAGRAPH, line
+            else:
+                yield quotedepth, FIXED, line
+
+    def _assemble(self, lines, options):
+        """Assemble classified lines into decoded chunks, see decode"""
+        limit = options.max_paragraph_chars
+        coalesce = options.coalesce_fixed
+        # Paragraph text is collected in a list, and joined when complete
+        para = []
+        size = 0
+        pinfo = {'type': PARAGRAPH}
+        # So are the lines of a fixed block, when coalescing
+        block = []
+        blockdepth = None
+        for quotedepth, type, line in lines:
+            if block:
+                if (type == FIXED and quotedepth == blockdepth and
+                        '\n' not in line):
+                    block.append(line)
+                    continue
+                yield _fixedChunk(block, blockdepth)
+                block = []
+            if type == SIGNATURE_SEPARATOR:
+                if size:
+                    # exception case: flowed line followed by sig-sep
+                    yield (pinfo, ''.join(para))
+                    pinfo = {'type': PARAGRAPH}
+                    para, size = [], 0
+                yield ({'type': SIGNATURE_SEPARATOR,
+                        'quotedepth': quotedepth}, line)
+                continue
+            if type == PARAGRAPH:
+                # flowed line; collect into a paragraph
+                if quotedepth != pinfo.get('quotedepth', quotedepth):
+                    # exception case: flowed line followed by quotedepth change
+                    yield (pinfo, ''.join(para))
+                    pinfo = {'type': PARAGRAPH}
+                    para, size = [], 0
+                elif limit and size >= limit:
+                    # paragraph too long; emit it in parts
+                    pinfo['continued'] = True
+                    yield (pinfo, ''.join(para))
+                    pinfo = {'type': PARAGRAPH}
+                    para, size = [], 0
+                para.append(line)
+                size += len(line)
+                pinfo['quotedepth'] = quotedepth
+                continue
+            # fixed line
+            if size:
+                # completed paragraph
+                if quotedepth != pinfo.get('quotedepth', quotedepth):
+                    # exception case: flowed line followed by quotedepth change
+                    yield (pinfo, ''.join(para))
+                    pinfo = {'type': PARAGRAPH}
+                    para, size = [], 0
+                else:
+                    para.append(line)
+                    yield (pinfo, ''.join(para))
+                    pinfo = {'type': PARAGRAPH}
+                    para, size = [], 0
+                    continue
+            if coalesce and '\n' not in line:
+                # a bare LF in a line would be taken for a block line break
+                block.append(line)
+                blockdepth = quotedepth
+                continue
+            yield ({'type': FIXED, 'quotedepth': quotedepth}, line)
+
+        if size:
+            # exception case: last line was a flowed line
+            yield (pinfo, ''.join(para))
+        elif block:
+            yield _fixedChunk(block, blockdepth)
+
+    def _vectorChunks(self, flowed, options, character_set):
+        """Decode flowed text window by window with NumPy, see decode
+
+        The chunks are the same as those decoded line by line. Text that
+        _vectorWindow can't decode the same way, such as the invalid UTF-8
+        byte at the end here, is decoded line by line from the start of its
+        window on:
+
+            >>> flowed = (b'> a \\r\\n> b\\r\\n\\xc3\\xa9 \\r\\nfixed\\r\\n' *
+            ...           20000 + b'\\xff')
+            >>> for options in (
+            ...         DecoderOptions(True, 'latin-1', coalesce_fixed=True),
+            ...         DecoderOptions(character_set='utf-8',
+            ...                        error_handling='replace')):
+            ...     decoder = FormatFlowedDecoder(options=options)
+            ...     assert list(decoder.decode(flowed)) == list(
+            ...         decoder._assemble(decoder._scanLines(
+            ...             flowed, options), options)), options
+
+        """
+        return chain.from_iterable(_vectorWindows(
+            flowed,
+            lambda data, offset, final: _vectorWindow(
+                data, options, character_set, final),
+            lambda offset: self._assemble(self._scanLines(
+                flowed[offset:], options), options)))
+
     # -- Public API ----------------------------------------------------
 
+    def getOptions(self):
+        """Return the current attributes as a DecoderOptions object
+
+            >>> FormatFlowedDecoder(delete_space=True).getOptions() == (
+            ...     DecoderOptions(delete_space=True))
+            True
+
+        """
+        return DecoderOptions(self.delete_space, self.character_set,
+                              self.error_handling, self.max_paragraph_chars,
+                              self.coalesce_fixed)
+
     def decode(self, flowed):
         """Decode flowed text
 
@@ -147,6 +389,14 @@ class FormatFlowedDecoder:
             One of PARAGRAPH, FIXED, SIGNATURE_SEPARATOR
           quotedepth
             Number of quotemarks found on the text chunk
+          continued
+            Only present (and True) on PARAGRAPH chunks that were cut short
+            because they reached max_paragraph_chars; the paragraph
+            continues in the next chunk.
+          block
+            Only present (and True) on FIXED chunks combining several fixed
+            lines, when coalesce_fixed is set; the lines are joined with
+            newlines.
 
         chunk is a unicode string. All text is unwrapped and without any
         quotemarks; when displaying these chunks, the appropriate quotemarks
@@ -154,6 +404,11 @@ class FormatFlowedDecoder:
         displayed wrapped. Chunks of type FIXED should be displayed
         unwrapped.
 
+        When NumPy is installed, texts larger than 64 KiB in UTF-8 or an
+        ASCII based single byte character set are decoded with array
+        operations over many lines at a time, unless max_paragraph_chars is
+        set. That is about twice as fast, and produces the same chunks.
+
 
         Examples
         --------
@@ -268,51 +523,80 @@ class FormatFlowedDecoder:
             ...    'This is a quoted paragraph encoded in cp037.')]
             True
 
-        """
-        para = ''
-        pinfo = {'type': PARAGRAPH}
-        for line in flowed.split(b'\r\n'):
-            line = line.decode(self.character_set, self.error_handling)
-            quotedepth, line = self._stripquotes(line)
-            line = self._stripstuffing(line)
-            if line == '-- ':
-                # signature separator
-                if para:
-                    # exception case: flowed line followed by sig-sep
-                    yield (pinfo, para)
-                    pinfo = {'type': PARAGRAPH}
-                    para = ''
-                yield ({'type': SIGNATURE_SEPARATOR,
-                        'quotedepth': quotedepth}, line)
-                continue
-            if line.endswith(' '):
-                # flowed line; collect into a paragraph
-                if quotedepth != pinfo.get('quotedepth', quotedepth):
-                    # exception case: flowed line followed by quotedepth change
-                    yield (pinfo, para)
-                    pinfo = {'type': PARAGRAPH}
-                    para = ''
-                para += self._stripflow(line)
-                pinfo['quotedepth'] = quotedepth
-                continue
-            # fixed line
-            if para:
-                # completed paragraph
-                if quotedepth != pinfo.get('quotedepth', quotedepth):
-                    # exception case: flowed line followed by quotedepth change
-                    yield (pinfo, para)
-                    pinfo = {'type': PARAGRAPH}
-                    para = ''
-                else:
-                    yield (pinfo, para + line)
-                    pinfo = {'type': PARAGRAPH}
-                    para = ''
-                    continue
-            yield ({'type': FIXED, 'quotedepth': quotedepth}, line)
+        The max_paragraph_chars attribute limits the size of paragraph chunks,
+        protecting against messages consisting of one endless paragraph.
+        Once the limit has been reached, the paragraph collected so far is
+        emitted with the continued flag set:
 
-        if para:
-            # exception case: last line was a flowed line
-            yield (pinfo, para)
+            >>> decoder = FormatFlowedDecoder(max_paragraph_chars=20)
+            >>> result = decoder.decode(CRLF.join((
+            ... b"A paragraph with ",
+            ... b"a few flowed lines ",
+            ... b"that runs on and on ",
+            ... b"and on.")))
+            >>> list(result) == [
+            ...   ({'quotedepth': 0, 'type': PARAGRAPH, 'continued': True},
+            ...    'A paragraph with a few flowed lines '),
+            ...   ({'quotedepth': 0, 'type': PARAGRAPH},
+            ...    'that runs on and on and on.')]
+            True
+
+        Paragraph chunks thus never exceed the limit by more than a single
+        line, however many lines the paragraph spans:
+
+            >>> decoder = FormatFlowedDecoder(max_paragraph_chars=1000)
+            >>> result = list(decoder.decode(
+            ...     b'All work and no play makes Jack a dull boy. \\r\\n' *
+            ...     100000))
+            >>> len(result)
+            4348
+            >>> max(len(chunk) for info, chunk in result)
+            1012
+            >>> [info.get('continued') for info, chunk in result[-2:]]
+            [True, None]
+
+        With the coalesce_fixed attribute set, runs of fixed lines at the
+        same quotedepth are emitted as a single block chunk:
+
+            >>> decoder = FormatFlowedDecoder(coalesce_fixed=True)
+            >>> result = decoder.decode(CRLF.join((
+            ... b"> if x:",
+            ... b">     return 1",
+            ... b"> A flowed ",
+            ... b"> paragraph.",
+            ... b"> ",
+            ... b">> Line one",
+            ... b">> Line two")))
+            >>> list(result) == [
+            ...   ({'quotedepth': 1, 'type': FIXED, 'block': True},
+            ...    'if x:\\n    return 1'),
+            ...   ({'quotedepth': 1, 'type': PARAGRAPH},
+            ...    'A flowed paragraph.'),
+            ...   ({'quotedepth': 1, 'type': FIXED}, ''),
+            ...   ({'quotedepth': 2, 'type': FIXED, 'block': True},
+            ...    'Line one\\nLine two')]
+            True
+
+        The lines of a block are the chunks decoded without coalescing:
+
+            >>> flowed = CRLF.join([b"log line"] * 10000 + [b"-- ", b"sig"])
+            >>> plain = list(FormatFlowedDecoder().decode(flowed))
+            >>> result = list(decoder.decode(flowed))
+            >>> len(plain), len(result)
+            (10002, 3)
+            >>> lines = [chunk for info, chunk in plain[:-2]]
+            >>> result[0][1].split('\\n') == lines
+            True
+
+        """
+        options = self.getOptions()
+        if (numpy is not None and isinstance(flowed, bytes) and
+                len(flowed) > _vector_window and
+                not options.max_paragraph_chars):
+            character_set = _vectorCharset(options.character_set)
+            if character_set is not None:
+                return self._vectorChunks(flowed, options, character_set)
+        return self._assemble(self._scanLines(flowed, options), options)
 
 
 class FormatFlowedEncoder:
@@ -336,14 +620,22 @@ class FormatFlowedEncoder:
         can still exceed this width. This value does not include the CRLF
         line endings.
 
+    Alternatively, pass in an EncoderOptions object as options; the other
+    arguments are then ignored.
+
+    Like decoders, encoders can be shared between threads; encode and
+    encodeChunk take a snapshot of the attributes when called and keep no
+    other state.
+
     """
     def __init__(self, extra_space=False, character_set='us-ascii',
-                 error_handling='strict', spacestuff_quoted=True, width=78):
-        self.extra_space = extra_space
-        self.character_set = character_set
-        self.error_handling = error_handling
-        self.spacestuff_quoted = spacestuff_quoted
-        self.width = width
+                 error_handling='strict', spacestuff_quoted=True, width=78,
+                 options=None):
+        if options is None:
+            options = EncoderOptions(extra_space, character_set,
+                                     error_handling, spacestuff_quoted, width)
+        (self.extra_space, self.character_set, self.error_handling,
+         self.spacestuff_quoted, self.width) = options
 
     def _spacestuff(self, line, force=False):
         """Prepend a space to lines starting with ' ', '>' or 'From'
@@ -386,9 +678,182 @@ class FormatFlowedEncoder:
             return ' ' + line
         return line
 
+    def _encodeChunk(self, options, chunk, type=PARAGRAPH, quotedepth=0,
+                     continued=False, block=False):
+        """Encode a chunk of text using options, see encodeChunk"""
+        lines = self._encodeLines(options, chunk, type, quotedepth, continued,
+                                  block)
+        lines.append(b'')  # ensure last ending CRLF
+        return b'\r\n'.join(lines)
+
+    def _encodeLines(self, options, chunk, type=PARAGRAPH, quotedepth=0,
+                     continued=False, block=False, limit=None):
+        """Encode a chunk of text to a list of lines, without CRLF
+
+        limit, if given, is a (max_bytes, max_lines) tuple, either of which
+        can be None. The chunk is then only encoded up to the point where
+        the lines, counting a CRLF for each, exceed max_bytes or number more
+        than max_lines:
+
+            >>> encoder = FormatFlowedEncoder(width=10)
+            >>> options = encoder.getOptions()
+            >>> lines = encoder._encodeLines(options, 'word ' * 10000,
+            ...                              limit=(None, 2))
+            >>> 2 < len(lines) < 100, set(lines) == set([b'word '])
+            (True, True)
+
+        """
+        # Paragraphs given in pieces are wrapped as the pieces are consumed;
+        # the text of other chunks is a single line anyway.
+        pieces = not isinstance(chunk, _text_type)
+        if pieces:
+            chunk = _iterPieces(chunk)
+            if type != PARAGRAPH:
+                chunk, pieces = ''.join(chunk), False
+
+        if limit is not None and type != SIGNATURE_SEPARATOR and not pieces:
+            # Encode ever longer prefixes of the chunk until there are enough
+            # lines. All but the last two lines of a prefix are encoded just
+            # as they would be for the whole chunk.
+            max_bytes, max_lines = limit
+            estimates = [options.width * max_lines] if max_lines else []
+            if max_bytes is not None:
+                estimates.append(max_bytes)
+            size = min(estimates or [0]) + 2 * options.width + 2
+            while size < len(chunk):
+                lines = self._encodeLines(options, chunk[:size], type,
+                                          quotedepth, continued, block)[:-2]
+                if (max_lines is not None and len(lines) > max_lines or
+                        max_bytes is not None and
+                        sum(len(line) + 2 for line in lines) > max_bytes):
+                    return lines
+                size *= 2
+
+        # cleanup: replace newlines with spaces and remove trailing spaces;
+        # with extra_space, trailing space on a continued paragraph separates
+        # it from the next chunk and must be retained.
+        # Fixed blocks are cleaned up line by line.
+        continued = continued and type == PARAGRAPH
+        block = block and type == FIXED
+        strip = not (continued and options.extra_space)
+        if block:
+            chunk = chunk.split('\n')
+            chunk = [' '.join(line.rstrip().splitlines()) for line in chunk]
+        elif not pieces:
+            if strip:
+                chunk = chunk.rstrip()
+            chunk = ' '.join(chunk.splitlines())
+
+        # Pre-encode quoting
+        quotemarker = '>' * quotedepth
+        quotemarker = quotemarker.encode(options.character_set)
+        forcestuff = options.spacestuff_quoted and quotedepth > 0
+
+        if type == SIGNATURE_SEPARATOR:
+            chunk = '-- '
+
+        if type == PARAGRAPH:
+            # Maximum width is reduced by stuffing and quotemarkers
+            width = options.width - len(quotemarker) - 2
+            if width <= 0:
+                raise ValueError('Not enough width for both quoting and text')
+            wrapper = _FlowedTextWrapper(width, options.extra_space)
+            if pieces:
+                chunk = wrapper._wrapPieces(chunk, strip)
+            else:
+                chunk = wrapper.wrap(chunk)
+        elif not block:
+            chunk = [chunk]
+
+        lines = []
+        size = 0
+        max_bytes, max_lines = limit or (None, None)
+        chunk = iter(chunk)
+        line = next(chunk, None)
+        while line is not None:
+            following = next(chunk, None)
+            # add space to flowed lines (all but last); this is an extra space
+            # if the wrapping of paragraphs included spaces at the end of the
+            # lines. The lines of a fixed block are never flowed.
+            if continued or following is not None and not block:
+                line += ' '
+            line = self._spacestuff(line, forcestuff)
+            line = quotemarker + line.encode(options.character_set,
+                                             options.error_handling)
+
+            # Enforce a hard limit of 998 characters per line (excluding CRLF)
+            # Unfortunately we can only enforce this *after* encoding,
+            # otherwise we could flow lines that are too long.
+            if len(line) > 998:
+                lines.extend(line[start:start + 998]
+                             for start in range(0, len(line), 998))
+            else:
+                lines.append(line)
+
+            if limit is not None:
+                # paragraphs given in pieces are only wrapped this far
+                size += len(line) + 2 * max(1, -(-len(line) // 998))
+                if (max_lines is not None and len(lines) > max_lines or
+                        max_bytes is not None and size > max_bytes):
+                    break
+            line = following
+        return lines
+
+    def _encodeBudget(self, options, chunks, max_bytes, max_lines, marker):
+        """Encode chunks within a budget, see encode"""
+        lines, separators = [], []
+        size = 0
+        truncated = None  # the quotedepth of the chunk cut short
+        for info, text in chunks:
+            limit = (None if max_bytes is None else max_bytes - size,
+                     None if max_lines is None else max_lines - len(lines))
+            separator = info.get('type') == SIGNATURE_SEPARATOR
+            for line in self._encodeLines(options, text, limit=limit, **info):
+                if (max_lines is not None and len(lines) >= max_lines or
+                        max_bytes is not None and
+                        size + len(line) + 2 > max_bytes):
+                    truncated = info.get('quotedepth', 0)
+                    break
+                lines.append(line)
+                separators.append(separator)
+                size += len(line) + 2
+            if truncated is not None:
+                break
+
+        if truncated is not None:
+            markerlines = []
+            if marker is not None:
+                markerlines = self._encodeLines(options, marker, FIXED,
+                                                truncated)
+                markersize = sum(len(line) + 2 for line in markerlines)
+                # make room for the marker
+                while lines and (
+                        max_lines is not None and
+                        len(lines) + len(markerlines) > max_lines or
+                        max_bytes is not None and
+                        size + markersize > max_bytes):
+                    size -= len(lines.pop()) + 2
+                    separators.pop()
+                if (max_lines is not None and len(markerlines) > max_lines or
+                        max_bytes is not None and markersize > max_bytes):
+                    markerlines = []  # the marker doesn't fit at all
+            if lines and not separators[-1]:
+                # a trailing space would flow the last line into what follows
+                lines[-1] = lines[-1].rstrip(b' ')
+            lines.extend(markerlines)
+
+        lines.append(b'')  # ensure last ending CRLF
+        return b'\r\n'.join(lines)
+
     # -- Public API ----------------------------------------------------
 
-    def encode(self, chunks):
+    def getOptions(self):
+        """Return the current attributes as an EncoderOptions object"""
+        return EncoderOptions(self.extra_space, self.character_set,
+                              self.error_handling, self.spacestuff_quoted,
+                              self.width)
+
+    def encode(self, chunks, max_bytes=None, max_lines=None, marker=None):
         """Encode chunks of text to format=flowed
 
         chunks
@@ -396,7 +861,21 @@ class FormatFlowedEncoder:
           is a dictionary with 'type' and 'quotedepth' keys. The 'type' value
           is one of PARAGRAPH, FIXED or SIGNATURE-SEPARATOR, and the
           'quotedepth' value a positive integer indicating the quoting depth.
-          text should be the unicode text to be encoded.
+          text should be the unicode text to be encoded, or for paragraphs
+          the text in pieces, see encodeChunk.
+        max_bytes (default: None)
+          The maximum size of the result in bytes, including line endings.
+        max_lines (default: None)
+          The maximum number of lines in the result.
+        marker (default: None)
+          Unicode text to end the result with when it had to be cut short to
+          stay within max_bytes or max_lines, as a FIXED line at the
+          quotedepth of the chunk that was cut short.
+
+        With a budget, encoding stops as soon as the budget is reached; no
+        more chunks are taken from chunks, and paragraphs are only wrapped as
+        far as needed. The result consists of complete, CRLF-terminated
+        lines; a paragraph that was cut short ends in a fixed line.
 
         Example
         -------
@@ -436,26 +915,65 @@ class FormatFlowedEncoder:
             ...   b""]
             True
 
+        Encoding the same chunks with a budget of 120 bytes:
+
+            >>> result = FormatFlowedEncoder(width=45).encode(
+            ...     chunks, max_bytes=120, marker='[...]')
+            >>> result.split(b'\\r\\n') == [
+            ...   b">> `Take some more tea,' the March Hare said ",
+            ...   b">> to Alice, very earnestly.",
+            ...   b">",
+            ...   b"> [...]",
+            ...   b""]
+            True
+
+        Only the chunks needed are consumed, even from an endless supply:
+
+            >>> import itertools
+            >>> endless = itertools.repeat(chunks[0])
+            >>> result = FormatFlowedEncoder().encode(endless, max_lines=50)
+            >>> result.count(b'\\r\\n'), result.endswith(b'earnestly.\\r\\n')
+            (50, True)
+
         """
+        options = self.getOptions()
+        if max_bytes is not None or max_lines is not None:
+            return self._encodeBudget(options, chunks, max_bytes, max_lines,
+                                      marker)
         encoded = []
         for info, text in chunks:
-            encoded.append(self.encodeChunk(text, **info))
+            encoded.append(self._encodeChunk(options, text, **info))
         return b''.join(encoded)
 
-    def encodeChunk(self, chunk, type=PARAGRAPH, quotedepth=0):
+    def encodeChunk(self, chunk, type=PARAGRAPH, quotedepth=0,
+                    continued=False, max_bytes=None, max_lines=None,
+                    marker=None, block=False):
         """Encode a chunk of text to format=flowed
 
         The chunk is encoded to format=flowed bytes, controlled by the
         following arguments.
         chunk
           The Unicode text to be encoded. Newlines are considered to be
-          whitespace and will be converted to spaces.
+          whitespace and will be converted to spaces. Paragraphs can also be
+          given in pieces, as an iterable of Unicode strings or a file-like
+          object opened in text mode (such as io.StringIO); these are wrapped
+          as the pieces are consumed, without joining them.
         type (default: PARAGRAPH)
           Chunk type; one of PARAGRAPH, FIXED or SIGNATURE_SEPARATOR. When
           called with type SIGNATURE_SEPARATOR the chunk is ignored and '-- '
           is written out.
         quotedepth (default: 0)
           The quote depth of the chunk.
+        continued (default: False)
+          Set on paragraph chunks that are continued in the next chunk, see
+          the max_paragraph_chars option of FormatFlowedDecoder. The last line
+          of such a chunk is flowed as well.
+        max_bytes, max_lines, marker (default: None)
+          Limit the size of the result, see encode.
+        block (default: False)
+          Set on FIXED chunks holding several fixed lines joined by newlines,
+          see the coalesce_fixed option of FormatFlowedDecoder. Each line is
+          then encoded as a fixed line of its own.
 
 
         Examples
@@ -511,6 +1029,10 @@ class FormatFlowedEncoder:
             ...     b" > eratic spacing and space fluffs \\r\\n"
             ...     b"characters where needed.\\r\\n")
             True
+            >>> encoder.encodeChunk('Repetitive ' * 8) == (
+            ...     b'Repetitive Repetitive Repetitive Repetitive \\r\\n'
+            ...     b'Repetitive Repetitive Repetitive Repetitive\\r\\n')
+            True
 
         - signature separators:
 
@@ -527,6 +1049,68 @@ class FormatFlowedEncoder:
             ...     b'-- \\r\\n')
             True
 
+        - continued paragraphs, which end in a flowed line:
+
+            >>> encoder.encodeChunk('A paragraph to be continued ',
+            ...                     continued=True) == (
+            ...     b'A paragraph to be continued \\r\\n')
+            True
+
+          Paragraphs cut short by the decoder thus survive a round trip:
+
+            >>> flowed = (b'A paragraph with \\r\\na few flowed lines \\r\\n'
+            ...           b'that runs on and on \\r\\nand on.\\r\\n')
+            >>> chunks = decode(flowed, max_paragraph_chars=20)
+            >>> list(decode(encode(chunks))) == [
+            ...   ({'quotedepth': 0, 'type': PARAGRAPH},
+            ...    'A paragraph with a few flowed lines that runs on and on '
+            ...    'and on.'),
+            ...   ({'quotedepth': 0, 'type': FIXED}, ''),
+            ...   ({'quotedepth': 0, 'type': FIXED}, '')]
+            True
+
+        - paragraphs in pieces, which encode just like the joined text:
+
+            >>> pieces = ['The   wrapping   deals   quite   well  with > er',
+            ...           'atic spacing\\r', '\\nand ', 'newlines ', 'in ',
+            ...           'pieces.  ']
+            >>> encoder.encodeChunk(pieces) == encoder.encodeChunk(
+            ...     ''.join(pieces))
+            True
+            >>> import io
+            >>> text = 'All work and no play makes Jack a dull boy. ' * 1000
+            >>> encoder.encodeChunk(io.StringIO(text), quotedepth=1) == (
+            ...     encoder.encodeChunk(text, quotedepth=1))
+            True
+
+          Only as many pieces are consumed as needed when the result is
+          limited:
+
+            >>> from itertools import count
+            >>> encoder.encodeChunk(('word %d ' % i for i in count()),
+            ...                     max_lines=2) == (
+            ...     b'word 0 word 1 word 2 word 3 word 4 word 5 \\r\\n'
+            ...     b'word 6 word 7 word 8 word 9 word 10 word 11\\r\\n')
+            True
+
+        - blocks of fixed lines:
+
+            >>> encoder.encodeChunk('def f(x):\\n    return x  \\n',
+            ...                     FIXED, 1, block=True) == (
+            ...     b'> def f(x):\\r\\n>     return x\\r\\n>\\r\\n')
+            True
+
+          Coalesced fixed lines thus encode just like the separate lines:
+
+            >>> flowed = b'\\r\\n'.join((
+            ...     b'> if x:', b'>      return 1', b'> A flowed ', b'>',
+            ...     b'> From here', b'', b'-- ', b'Sig'))
+            >>> coalesced = list(decode(flowed, coalesce_fixed=True))
+            >>> len(coalesced), len(list(decode(flowed)))
+            (6, 7)
+            >>> encode(coalesced) == encode(decode(flowed))
+            True
+
 
         Encoder options
         ---------------
@@ -584,50 +1168,228 @@ class FormatFlowedEncoder:
             >>> result == [b'-' * 998, b'-' * 502, b'']
             True
 
+        Only the first lines of a long paragraph are wrapped when the result
+        is limited:
+
+            >>> encoder.encodeChunk('word ' * 10 ** 6, max_lines=2,
+            ...                     marker='...') == (
+            ...     b'word ' * 14 + b'word\\r\\n...\\r\\n')
+            True
+
         """
-        # cleanup: replace newlines with spaces and remove trailing spaces
-        chunk = ' '.join(chunk.rstrip().splitlines())
+        options = self.getOptions()
+        if max_bytes is not None or max_lines is not None:
+            info = {'type': type, 'quotedepth': quotedepth,
+                    'continued': continued, 'block': block}
+            return self._encodeBudget(options, [(info, chunk)], max_bytes,
+                                      max_lines, marker)
+        return self._encodeChunk(options, chunk, type, quotedepth, continued,
+                                 block)
+
+
+class FormatFlowedEncoderSession(FormatFlowedEncoder):
+    """Format=flowed encoder for repeatedly encoding edited text
+
+    Takes the same attributes as FormatFlowedEncoder, but remembers the
+    encoded bytes for each chunk of text between calls to encode. Chunks that
+    are unchanged since the last call are not wrapped and encoded again, so
+    re-encoding an edited text costs time proportional to the size of the
+    edits. Only the chunks of the last call are remembered, and changing any
+    of the encoder attributes invalidates them all.
+
+    A session holds the state for a single text being edited and should not
+    be shared between texts. It can be shared between threads working on
+    that text: concurrent encode calls never wait for one another, and each
+    uses the chunks remembered by whichever earlier call completed last.
 
-        # Pre-encode quoting
-        quotemarker = '>' * quotedepth
-        quotemarker = quotemarker.encode(self.character_set)
-        forcestuff = self.spacestuff_quoted and quotedepth > 0
+    """
+    def __init__(self, *args, **kwargs):
+        FormatFlowedEncoder.__init__(self, *args, **kwargs)
+        # (options, cache) pair, replaced as a whole so threads always see a
+        # cache together with the options it was encoded with
+        self._state = (None, {})
+
+    def encode(self, chunks, max_bytes=None, max_lines=None, marker=None):
+        """Encode chunks of text to format=flowed, reusing earlier results
+
+        See FormatFlowedEncoder.encode for a description of chunks. Here we
+        count how often chunks are actually encoded:
+
+            >>> encoded = []
+            >>> class CountingSession(FormatFlowedEncoderSession):
+            ...     def _encodeChunk(self, options, chunk, *args, **kwargs):
+            ...         encoded.append(chunk)
+            ...         return FormatFlowedEncoderSession._encodeChunk(
+            ...             self, options, chunk, *args, **kwargs)
+            >>> session = CountingSession(width=30)
+            >>> draft = [
+            ...   ({'quotedepth': 1, 'type': PARAGRAPH},
+            ...    "`Take some more tea,' the March Hare said to Alice, "
+            ...    "very earnestly."),
+            ...   ({'quotedepth': 0, 'type': FIXED}, ""),
+            ...   ({'quotedepth': 0, 'type': PARAGRAPH}, "I've had nothing")]
+            >>> session.encode(draft) == encode(draft, width=30)
+            True
+            >>> len(encoded)
+            3
 
-        if type == SIGNATURE_SEPARATOR:
-            chunk = '-- '
+        Editing one paragraph only encodes that paragraph again:
 
-        if type == PARAGRAPH:
-            # Maximum width is reduced by stuffing and quotemarkers
-            width = self.width - len(quotemarker) - 2
-            if width <= 0:
-                raise ValueError('Not enough width for both quoting and text')
-            wrapper = _FlowedTextWrapper(width, self.extra_space)
-            chunk = wrapper.wrap(chunk)
-        else:
-            chunk = [chunk]
+            >>> del encoded[:]
+            >>> draft[-1] = ({'quotedepth': 0, 'type': PARAGRAPH},
+            ...              "I've had nothing yet, so I can't take more.")
+            >>> session.encode(draft) == encode(draft, width=30)
+            True
+            >>> encoded == ["I've had nothing yet, so I can't take more."]
+            True
 
-        lines = []
-        for line in chunk:
-            # add space to flowed lines (all but last); this is an extra space
-            # if the wrapping of paragraphs included spaces at the end of the
-            # lines.
-            if line != chunk[-1]:
-                line += ' '
-            line = self._spacestuff(line, forcestuff)
-            line = quotemarker + line.encode(self.character_set,
-                                             self.error_handling)
+        while changing the encoder attributes encodes everything again:
 
-            # Enforce a hard limit of 998 characters per line (excluding CRLF)
-            # Unfortunately we can only enforce this *after* encoding,
-            # otherwise we could flow lines that are too long.
-            while len(line) > 998:
-                lines.append(line[:998])
-                line = line[998:]
+            >>> del encoded[:]
+            >>> session.width = 45
+            >>> session.encode(draft) == encode(draft, width=45)
+            True
+            >>> len(encoded)
+            3
 
-            lines.append(line)
+        Encoding within a budget, see FormatFlowedEncoder.encode, does not use
+        or update the remembered chunks, and neither are paragraphs given in
+        pieces remembered.
 
-        lines.append(b'')  # ensure last ending CRLF
-        return b'\r\n'.join(lines)
+        """
+        if max_bytes is not None or max_lines is not None:
+            return FormatFlowedEncoder.encode(self, chunks, max_bytes,
+                                              max_lines, marker)
+        options = self.getOptions()
+        cached_options, previous = self._state
+        if options != cached_options:
+            previous = {}
+        cache = {}
+        encoded = []
+        for info, text in chunks:
+            if not isinstance(text, _text_type):
+                # text in pieces can only be consumed once
+                encoded.append(self._encodeChunk(options, text, **info))
+                continue
+            key = (text,) + tuple(sorted(info.items()))
+            data = cache.get(key)
+            if data is None:
+                data = previous.get(key)
+                if data is None:
+                    data = self._encodeChunk(options, text, **info)
+                cache[key] = data
+            encoded.append(data)
+        self._state = (options, cache)
+        return b''.join(encoded)
+
+
+class FormatFlowedDocument:
+    """Decoded format=flowed text, ready to be wrapped at any width
+
+    The flowed bytestring is decoded once, on creation, recording for each
+    chunk of text where it divides into words and whitespace. The render
+    method then wraps the text to a given width without having to decode or
+    split it again. All keyword arguments are passed to the
+    FormatFlowedDecoder instance used to decode the text.
+
+    A document is not altered after creation; any number of threads can
+    render it at the same time.
+
+    """
+    def __init__(self, flowed, **kwargs):
+        splitter = _TextWrapper(replace_whitespace=False)
+        chunks = []
+        parts = []  # earlier parts of a paragraph, see max_paragraph_chars
+        for info, chunk in decode(flowed, **kwargs):
+            type, quotedepth = info['type'], info['quotedepth']
+            if type == PARAGRAPH:
+                parts.append(chunk)
+                if info.get('continued'):
+                    continue
+                chunk, parts = ''.join(parts), []
+            # fixed blocks are rendered line by line
+            lines = chunk.split('\n') if info.get('block') else [chunk]
+            for chunk in lines:
+                if not chunk or type == SIGNATURE_SEPARATOR:
+                    chunks.append((type, quotedepth, chunk, None, None, None))
+                    continue
+                text = splitter._munge_whitespace(chunk)
+                ends, blanks = _offsetArray(len(text)), bytearray()
+                end = 0
+                for token in splitter._split(text):
+                    end += len(token)
+                    ends.append(end)
+                    blanks.append(not token.strip())
+                if text == chunk:
+                    text = chunk
+                chunks.append((type, quotedepth, chunk, text, ends, blanks))
+        self._chunks = chunks
+
+    def render(self, width=78, quote='>', wrap_fixed=True):
+        """Wrap the text to the given width
+
+        The arguments are interpreted as they are by convertToWrapped, and the
+        result is the same:
+
+            >>> CRLF = b'\\r\\n'
+            >>> flowed = CRLF.join((
+            ... b">> `Take some more tea,' the March Hare said to Alice, ",
+            ... b">> very earnestly.",
+            ... b">",
+            ... b"> `I've had nothing yet,' Alice replied in an offended ",
+            ... b"> tone, `so I can't take more.'",
+            ... b"",
+            ... b"`You mean you can't take less,' said the Hatter: `it's ",
+            ... b"very easy to take more than nothing.'",
+            ... b"",
+            ... b"\\tsupercalifragilistic \\t tabbed fixed text",
+            ... b"-- ",
+            ... b"Lewis Caroll"))
+            >>> document = FormatFlowedDocument(flowed)
+            >>> document.render(40).split('\\n') == [
+            ...   ">> `Take some more tea,' the March Hare",
+            ...   ">> said to Alice, very earnestly.",
+            ...   "> ",
+            ...   "> `I've had nothing yet,' Alice replied",
+            ...   "> in an offended tone, `so I can't take",
+            ...   "> more.'",
+            ...   "",
+            ...   "`You mean you can't take less,' said the",
+            ...   "Hatter: `it's very easy to take more",
+            ...   "than nothing.'",
+            ...   "",
+            ...   "        supercalifragilistic     tabbed",
+            ...   "fixed text",
+            ...   "-- ",
+            ...   "Lewis Caroll"]
+            True
+            >>> all(document.render(width, quote, wrap_fixed) ==
+            ...     convertToWrapped(flowed, width, quote, wrap_fixed)
+            ...     for width in range(1, 80)
+            ...     for quote in ('>', '> ', '|>|')
+            ...     for wrap_fixed in (True, False))
+            True
+
+        The parts of paragraphs cut at max_paragraph_chars are wrapped as
+        one:
+
+            >>> flowed = b'word \\r\\n' * 30 + b'end'
+            >>> document = FormatFlowedDocument(flowed, max_paragraph_chars=50)
+            >>> document.render(40) == FormatFlowedDocument(flowed).render(40)
+            True
+
+        """
+        result = []
+        for type, quotedepth, chunk, text, ends, blanks in self._chunks:
+            quotemarker = quotedepth and quote * quotedepth or ''
+            if quotemarker and quote[-1] != ' ':
+                quotemarker += ' '
+            if ends is None or (type == FIXED and not wrap_fixed):
+                result.append(quotemarker + chunk)
+            else:
+                result.extend(_wrapTokens(chunk, text, ends, blanks, width,
+                                          quotemarker))
+        return '\n'.join(result)
 
 
 # -- Convenience functions ---------------------------------------------
@@ -644,32 +1406,545 @@ def decode(flowed, **kwargs):
     return decoder.decode(flowed)
 
 
-def encode(chunks, **kwargs):
+def encode(chunks, max_bytes=None, max_lines=None, marker=None, **kwargs):
     """Convert chunks of Unicode text to format=flowed
 
     See the FormatFlowedEncoder.encode docstring for more information. All
-    keyword arguments are passed to the FormatFlowedEncoder instance.
+    other keyword arguments are passed to the FormatFlowedEncoder instance.
 
     """
     encoder = FormatFlowedEncoder(**kwargs)
-    return encoder.encode(chunks)
+    return encoder.encode(chunks, max_bytes, max_lines, marker)
 
 
-def convertToWrapped(flowed, width=78, quote='>', wrap_fixed=True, **kwargs):
-    """Covert flowed bytes to encoded and wrapped text
+def reflow(flowed, from_options=None, to_options=None, stream=None):
+    """Convert format=flowed bytes to format=flowed bytes with other options
 
-    Create text suitable for a proportional font, fixed with, plain text
-    display. The argements are interpreted as follows:
+    Re-wraps flowed text to another width, switches between DelSp and plain
+    flowed lines, or changes the character set. The arguments are:
       flowed
         The format=flowed formatted bytestring to convert
-      width (default: 78)
-        The maximum line length at which to wrap paragraphs.
-      quote (default: '>')
-        Character sequence to use to mark quote depths; it is multiplied with
-        the quotedepth to quote a line. If this sequence does not end in a
-        space a space is added between the quotemarks and the line.
-      wrap_fixed (default: True)
-        If true, fixed text chunks are wrapped to the given  width as well,
+      from_options (default: None)
+        The DecoderOptions to decode the bytestring with; the default options
+        if not given.
+      to_options (default: None)
+        The EncoderOptions to encode the result with; the default options if
+        not given.
+      stream (default: None)
+        A file-like object to write the bytes to, as each chunk is encoded,
+        in which case None is returned. If not given, the bytes are returned.
+
+    Each decoded chunk is encoded as soon as it is decoded, no more than one
+    paragraph is held in memory at any time:
+
+        >>> CRLF = b'\\r\\n'
+        >>> flowed = CRLF.join((
+        ... b"> `Take some more tea,' the March Hare said to Alice, very ",
+        ... b"> earnestly.",
+        ... b"-- ",
+        ... b"Lewis Carroll"))
+        >>> reflow(flowed, to_options=EncoderOptions(
+        ...     width=30, extra_space=True)).split(CRLF) == [
+        ...   b"> `Take some more tea,' the  ",
+        ...   b"> March Hare said to Alice,  ",
+        ...   b"> very earnestly.",
+        ...   b"-- ",
+        ...   b"Lewis Carroll",
+        ...   b""]
+        True
+
+    When re-encoding would produce the same lines, the text is returned
+    as-is. That is the case when the character sets match, the text decodes
+    without errors, the flow spaces are interpreted the same way and every
+    line is already stuffed and wrapped as the encoder would, fitting the
+    target width but too full to take the next word:
+
+        >>> reflow(flowed, to_options=EncoderOptions(width=60)) is flowed
+        True
+
+    Text wrapped narrower is re-wrapped to the target width, and lines are
+    stuffed where needed:
+
+        >>> narrow = reflow(flowed, to_options=EncoderOptions(width=30))
+        >>> narrow.split(CRLF) == [
+        ...   b"> `Take some more tea,' the ",
+        ...   b"> March Hare said to Alice, ",
+        ...   b"> very earnestly.",
+        ...   b"-- ",
+        ...   b"Lewis Carroll",
+        ...   b""]
+        True
+        >>> reflow(narrow, to_options=EncoderOptions(width=60)).split(
+        ...     CRLF) == flowed.split(CRLF) + [b"", b""]
+        True
+        >>> reflow(b'From here on \\r\\nit goes') == (
+        ...     b' From here on it goes\\r\\n')
+        True
+
+    """
+    if from_options is None:
+        from_options = DecoderOptions()
+    if to_options is None:
+        to_options = EncoderOptions()
+    if _reflowUnchanged(flowed, from_options, to_options):
+        if stream is None:
+            return flowed
+        stream.write(flowed)
+        return
+
+    decoder = FormatFlowedDecoder(options=from_options)
+    encoder = FormatFlowedEncoder(options=to_options)
+    encoded = (encoder._encodeChunk(to_options, text, **info)
+               for info, text in decoder.decode(flowed))
+    if stream is None:
+        return b''.join(encoded)
+    write = stream.write
+    for data in encoded:
+        write(data)
+
+
+def scan(flowed, delete_space=False, character_set='us-ascii'):
+    """Collect statistics on format=flowed bytes without decoding them
+
+    Makes a single pass over the lines of the bytestring, without decoding
+    the text or collecting paragraphs, and returns a dictionary with:
+      flowed
+        True if any of the lines is flowed.
+      paragraphs
+        The number of PARAGRAPH chunks decode would produce.
+      max_quotedepth
+        The highest quotedepth found.
+      quoted_ratio
+        The fraction of the text bytes, not counting quotemarks, stuffing and
+        line endings, that is quoted.
+      signature
+        True if an unquoted signature separator is present.
+      longest_line
+        The length in bytes of the longest line, excluding the CRLF.
+
+    The delete_space and character_set arguments are interpreted as they are
+    by FormatFlowedDecoder. The character set must encode the quotemark,
+    space and dash as single bytes, otherwise a ValueError is raised.
+
+        >>> CRLF = b'\\r\\n'
+        >>> stats = scan(CRLF.join((
+        ... b">> `Take some more tea,' the March Hare said to Alice, ",
+        ... b">> very earnestly.",
+        ... b">",
+        ... b"> `I've had nothing yet,' Alice replied in an offended ",
+        ... b"> tone, `so I can't take more.'",
+        ... b"",
+        ... b"`You mean you can't take less,' said the Hatter: `it's ",
+        ... b"very easy to take more than nothing.'",
+        ... b"",
+        ... b"-- ",
+        ... b"Lewis Carroll")))
+        >>> stats == {'flowed': True, 'paragraphs': 3, 'max_quotedepth': 2,
+        ...           'quoted_ratio': 149 / 257.0, 'signature': True,
+        ...           'longest_line': 55}
+        True
+
+    """
+    quote, space, dash = ('>', ' ', '-')
+    try:
+        quote, space, dash = [
+            marker.encode(character_set) for marker in (quote, space, dash)]
+    except UnicodeEncodeError:
+        pass
+    if not len(quote) == len(space) == len(dash) == 1:
+        raise ValueError('Cannot scan %s encoded text' % character_set)
+    separator = dash + dash + space
+
+    flowedlines = signature = False
+    paragraphs = max_quotedepth = longest_line = quoted = unquoted = 0
+    # Track the paragraph decode would be collecting
+    size, pdepth = 0, None
+    for line in _splitlines(flowed):
+        if len(line) > longest_line:
+            longest_line = len(line)
+        stripped = line.lstrip(quote)
+        quotedepth = len(line) - len(stripped)
+        stuffed = stripped.startswith(space)
+        textsize = len(stripped) - stuffed
+        if quotedepth:
+            quoted += textsize
+            if quotedepth > max_quotedepth:
+                max_quotedepth = quotedepth
+        else:
+            unquoted += textsize
+
+        if textsize == 3 and stripped.endswith(separator):
+            # signature separator
+            if size:
+                paragraphs += 1
+                size, pdepth = 0, None
+            if not quotedepth:
+                signature = True
+        elif textsize and stripped.endswith(space):
+            # flowed line
+            flowedlines = True
+            if quotedepth != pdepth and pdepth is not None:
+                paragraphs += 1
+                size = 0
+            size += textsize - bool(delete_space)
+            pdepth = quotedepth
+        elif size:
+            # fixed line, completing a paragraph
+            paragraphs += 1
+            size, pdepth = 0, None
+    if size:
+        paragraphs += 1
+
+    return {
+        'flowed': flowedlines,
+        'paragraphs': paragraphs,
+        'max_quotedepth': max_quotedepth,
+        'quoted_ratio': quoted / float(quoted + unquoted or 1),
+        'signature': signature,
+        'longest_line': longest_line,
+    }
+
+
+def iterTokens(flowed, **kwargs):
+    """Iterate over the words in format=flowed bytes
+
+    Yields a (word, quotedepth, start, end) tuple for every run of
+    non-whitespace characters in the text decode would produce, where start
+    and end are the offsets of the word in the flowed bytestring. The text is
+    processed line by line, without collecting paragraphs; only words
+    continuing across a flowed line are joined. Signature separators are not
+    words and are skipped. All keyword arguments are interpreted as they are
+    by FormatFlowedDecoder, which also requires the character set to encode
+    the quotemark and space as single bytes.
+
+    The offsets are those of the bytes each word was decoded from, also when
+    the error handler replaces or drops invalid bytes. As with decode, texts
+    larger than 64 KiB in UTF-8 or an ASCII based single byte character set
+    are tokenized with array operations when NumPy is installed, which is
+    three to four times as fast. Producing a tuple with offsets for every
+    word costs time even so: when only the words are needed, splitting the
+    chunks decode produces is still about one and a half times as fast with
+    NumPy, and three times as fast without, at the cost of holding whole
+    paragraphs in memory.
+
+        >>> CRLF = b'\\r\\n'
+        >>> flowed = CRLF.join((
+        ...     b"> `Take some more tea,' the March ",
+        ...     b">> Hare said.",
+        ...     b"-- ",
+        ...     b"Lewis Carroll"))
+        >>> [token[:2] for token in iterTokens(flowed)] == [
+        ...     ("`Take", 1), ('some', 1), ('more', 1), ("tea,'", 1),
+        ...     ('the', 1), ('March', 1), ('Hare', 2), ('said.', 2),
+        ...     ('Lewis', 0), ('Carroll', 0)]
+        True
+
+    With delete_space set, words can continue on the next line; the offsets
+    of such a word span the line break:
+
+        >>> flowed = CRLF.join((b"> Un ", b"> ex ", b"> cept ", b"> ional."))
+        >>> list(iterTokens(flowed, delete_space=True)) == [
+        ...     ('Unexceptional.', 1, 2, len(flowed))]
+        True
+
+    The words are the same as those found by splitting the decoded chunks:
+
+        >>> flowed = CRLF.join((
+        ...     b"> Quot ", b">>  Stuffed ", b">> 20\\xe2\\x82\\xac ",
+        ...     b">> more", b"-- ", b"Sig ", b" ", b" \\xe2\\x82\\xac"))
+        >>> for delete_space in (False, True):
+        ...     kwargs = dict(delete_space=delete_space, character_set='utf-8')
+        ...     words = [(word, info['quotedepth'])
+        ...              for info, chunk in decode(flowed, **kwargs)
+        ...              if info['type'] != SIGNATURE_SEPARATOR
+        ...              for word in chunk.split()]
+        ...     tokens = list(iterTokens(flowed, **kwargs))
+        ...     assert [token[:2] for token in tokens] == words, tokens
+        ...     for word, quotedepth, start, end in tokens:
+        ...         if flowed[start:end].decode('utf-8') != word:
+        ...             assert delete_space and CRLF in flowed[start:end]
+        >>> tokens[1:] == [('Stuffed20\\u20acmore', 2, 13, 41),
+        ...                ('Sig', 0, 48, 51), ('\\u20ac', 0, 58, 61)]
+        True
+
+    Offsets into invalid bytes are exact as well, whatever the error handler:
+
+        >>> flowed = b'\\xff> A b\\xe2\\x82 c\\xc3\\xa9\\xff'
+        >>> list(iterTokens(flowed, character_set='utf-8',
+        ...                 error_handling='ignore')) == [
+        ...     ('A', 1, 3, 4), ('b', 1, 5, 6), ('c\\xe9', 1, 9, 12)]
+        True
+        >>> list(iterTokens(flowed, character_set='utf-8',
+        ...                 error_handling='replace')) == [
+        ...     ('\\ufffd>', 0, 0, 2), ('A', 0, 3, 4),
+        ...     ('b\\ufffd', 0, 5, 8), ('c\\xe9\\ufffd', 0, 9, 13)]
+        True
+
+    """
+    options = FormatFlowedDecoder(**kwargs).getOptions()
+    quote, space = '>', ' '
+    try:
+        quote, space = [marker.encode(options.character_set)
+                        for marker in (quote, space)]
+    except UnicodeEncodeError:
+        pass
+    if not len(quote) == len(space) == 1:
+        raise ValueError('Cannot tokenize %s encoded text' %
+                         options.character_set)
+    if numpy is not None and len(flowed) > _vector_window:
+        character_set = _vectorCharset(options.character_set)
+        if character_set is not None:
+            spaces = _vectorSpaces(character_set)
+            return chain.from_iterable(_vectorWindows(
+                flowed,
+                lambda data, offset, final: _vectorTokens(
+                    data, offset, options, character_set, spaces, final),
+                lambda offset: chain.from_iterable(_lineTokens(
+                    flowed[offset:], options, space, offset))))
+    return chain.from_iterable(_lineTokens(flowed, options, space))
+
+
+def _lineTokens(flowed, options, space, offset=0):
+    """Find the words in flowed bytes line by line, see iterTokens
+
+    The lines are classified by _scanLines, as decode does, and the words of
+    their texts are found at offsets that follow from the bytes of the lines:
+    the texts start after the quotemarks and stuffing, and each character is
+    a byte, unless _wordOffsets finds otherwise. Only error handlers that
+    don't replace each invalid byte or sequence with a single character can
+    drop or produce quotemarks and spaces; lines they decode are mapped to
+    their bytes character by character, see _charEnds. Yields a list of
+    tokens per line.
+
+    """
+    character_set, error_handling = (options.character_set,
+                                     options.error_handling)
+    delete_space = options.delete_space
+    lossy = error_handling not in ('strict', 'replace', 'surrogateescape')
+    word_finditer = _word_finditer
+    lines = _splitlines(flowed)
+    decoder = FormatFlowedDecoder(options=options)
+    scanned = decoder._scanLines(flowed, options)
+
+    # The pieces of a word at the end of a flowed line, which may continue
+    # on the next line, and the (quotedepth, start, end) of that word
+    pieces, pending = [], None
+    for quotedepth, type, text in scanned:
+        line = next(lines)
+        start, offset = offset, offset + len(line) + 2
+        if type == SIGNATURE_SEPARATOR:
+            if pieces:
+                yield [(''.join(pieces),) + pending]
+                del pieces[:]
+            continue
+        flowedline = type == PARAGRAPH
+        continues = flowedline and delete_space
+        if pieces and (quotedepth != pending[0] or text[:1].isspace() or
+                       not (text or flowedline)):
+            # the paragraph ends, or the next line starts a new word
+            yield [(''.join(pieces),) + pending]
+            del pieces[:]
+
+        ends = None
+        if lossy:
+            try:
+                line.decode(character_set)
+            except UnicodeDecodeError:
+                decoded = line.decode(character_set, error_handling)
+                ends = _charEnds(line, character_set, error_handling)
+        if ends is not None:
+            first = len(decoded) - continues - len(text)
+            words = [(word, quotedepth, wordstart, wordend)
+                     for word, wordstart, wordend in _mapWords(
+                         decoded, ends, start, first, first + len(text))]
+        else:
+            # the text follows the quotemarks and stuffing
+            first = quotedepth + (line[quotedepth:quotedepth + 1] == space)
+            line = line[first:len(line) - continues]
+            start += first
+            if len(line) == len(text):
+                # one byte per character
+                words = [(match.group(), quotedepth, start + match.start(),
+                          start + match.end())
+                         for match in word_finditer(text)]
+            else:
+                words = [(word, quotedepth, wordstart, wordend)
+                         for word, wordstart, wordend in _wordOffsets(
+                             line, text, start, space, character_set,
+                             error_handling)]
+
+        # the last word continues on the next line
+        last = len(words)
+        if continues and words and not text[-1:].isspace():
+            last -= 1
+        if pieces and words:
+            # the first word continues the word on the previous line
+            word, quotedepth, wordstart, wordend = words[0]
+            pieces.append(word)
+            if last:
+                words[0] = (''.join(pieces), quotedepth, pending[1], wordend)
+                del pieces[:]
+            else:
+                pending = (quotedepth, pending[1], wordend)
+        if last < len(words) and not pieces:
+            word, quotedepth, wordstart, wordend = words[last]
+            pieces.append(word)
+            pending = (quotedepth, wordstart, wordend)
+        if last:
+            yield words if last == len(words) else words[:last]
+        if pieces and not continues:
+            yield [(''.join(pieces),) + pending]
+            del pieces[:]
+    if pieces:
+        yield [(''.join(pieces),) + pending]
+
+
+def _wordOffsets(line, text, start, space, character_set, error_handling):
+    """Find the words of a decoded line and their offsets in its bytes
+
+    text is line decoded; start the offset of line in the flowed bytes.
+    Returns a list of (word, start, end) tuples. The bytes between spaces
+    are decoded separately to find where each word starts and ends, unless
+    that doesn't decode to the same text; then the line is decoded byte by
+    byte:
+
+        >>> line = '\\u20ac1 \\xa0x\\xa0yz'.encode('utf-8') + b' \\xff!'
+        >>> for error_handling in ('replace', 'ignore'):
+        ...     text = line.decode('utf-8', error_handling)
+        ...     words = _wordOffsets(line, text, 10, b' ', 'utf-8',
+        ...                          error_handling)
+        ...     assert [word for word, s, e in words] == text.split()
+        ...     print([(s, e) for word, s, e in words])
+        [(10, 14), (17, 18), (20, 22), (23, 25)]
+        [(10, 14), (17, 18), (20, 22), (23, 25)]
+        >>> words = _wordOffsets(line[:2], '\\ufffd', 0, b' ', 'utf-8',
+        ...                      'replace')
+        >>> words == [('\\ufffd', 0, 2)]
+        True
+
+    """
+    fields = line.split(space)
+    decoded = [field.decode(character_set, error_handling)
+               for field in fields]
+    if ' '.join(decoded) != text:
+        fields, decoded = [line], [text]
+    words = []
+    offset = start
+    for field, text in zip(fields, decoded):
+        if not text:
+            pass
+        elif not _whitespace_search(text):
+            words.append((text, offset, offset + len(field)))
+        elif len(field) == len(text):
+            words.extend((match.group(), offset + match.start(),
+                          offset + match.end())
+                         for match in _word_finditer(text))
+        else:
+            words.extend(_mapWords(text, _charEnds(
+                field, character_set, error_handling), offset))
+        offset += len(field) + 1
+    return words
+
+
+def _charEnds(line, character_set, error_handling):
+    """Decode line byte by byte, listing where the bytes of each character end
+
+        >>> _charEnds(b'a\\xe2\\x82\\xac\\xe2b', 'utf-8', 'replace')
+        [1, 4, 5, 6]
+
+    Characters replacing an invalid sequence all end before it, bar the last
+    (Python 2 cannot decode with backslashreplace):
+
+        >>> import sys
+        >>> sys.version_info < (3, 5) or _charEnds(
+        ...     b'\\xff-', 'utf-8', 'backslashreplace') == [0, 0, 0, 1, 2]
+        True
+
+    """
+    decoder = codecs.getincrementaldecoder(character_set)(error_handling)
+    ends = []
+    start = 0
+    for index in range(len(line)):
+        chars = decoder.decode(line[index:index + 1])
+        if chars:
+            # an invalid sequence is only ended by the next byte, which may
+            # be held by the decoder or produce a character of its own
+            end = index + 1 - len(decoder.getstate()[0])
+            ends.extend(_spanEnds(line, start, end, chars, character_set,
+                                  error_handling))
+            start = end
+    chars = decoder.decode(b'', True)
+    ends.extend(_spanEnds(line, start, len(line), chars, character_set,
+                          error_handling))
+    return ends
+
+
+def _spanEnds(line, start, end, chars, character_set, error_handling):
+    """List where chars, decoded from line[start:end], end, see _charEnds
+
+    A decoder can hold on to an invalid sequence together with the bytes
+    following it; Python 2 decodes all of these at once:
+
+        >>> _spanEnds(b'a\\xe2bc', 1, 4, '\\ufffdbc', 'utf-8', 'replace')
+        [2, 3, 4]
+
+    """
+    if len(chars) < 2:
+        return [end] * len(chars)
+    # Decode the span again, passing invalid sequences to the error handler
+    handler = codecs.lookup_error(error_handling)
+    span = line[start:end]
+    ends, decoded = [], []
+    pos = 0
+    while pos < len(span):
+        try:
+            span[pos:].decode(character_set)
+            valid, error = len(span) - pos, None
+        except UnicodeDecodeError as e:
+            valid, error = e.start, e
+        decoder = codecs.getincrementaldecoder(character_set)()
+        for index in range(pos, pos + valid):
+            text = decoder.decode(span[index:index + 1])
+            decoded.append(text)
+            ends.extend([start + index + 1] * len(text))
+        if error is None:
+            break
+        text, newpos = handler(error)
+        decoded.append(text)
+        ends.extend([start + pos + error.start] * (len(text) - 1))
+        pos += newpos
+        ends.append(start + pos)
+    if ''.join(decoded) != chars:
+        # the codec decodes the span differently on its own
+        return [start] * (len(chars) - 1) + [end]
+    return ends
+
+
+def _mapWords(text, ends, start, pos=0, endpos=None):
+    """Find the words in text[pos:endpos] and their offsets, see _charEnds"""
+    if endpos is None:
+        endpos = len(text)
+    return [(match.group(),
+             start + (match.start() and ends[match.start() - 1]),
+             start + ends[match.end() - 1])
+            for match in _word_finditer(text, pos, endpos)]
+
+
+def convertToWrapped(flowed, width=78, quote='>', wrap_fixed=True, **kwargs):
+    """Covert flowed bytes to encoded and wrapped text
+
+    Create text suitable for a proportional font, fixed with, plain text
+    display. The argements are interpreted as follows:
+      flowed
+        The format=flowed formatted bytestring to convert
+      width (default: 78)
+        The maximum line length at which to wrap paragraphs.
+      quote (default: '>')
+        Character sequence to use to mark quote depths; it is multiplied with
+        the quotedepth to quote a line. If this sequence does not end in a
+        space a space is added between the quotemarks and the line.
+      wrap_fixed (default: True)
+        If true, fixed text chunks are wrapped to the given  width as well,
         including hard word breaks if a word exceeds the line width
 
       The remaining arguments are used as arguments to FormatFlowedDecoder.
@@ -703,23 +1978,75 @@ def convertToWrapped(flowed, width=78, quote='>', wrap_fixed=True, **kwargs):
         ...   "Lewis Caroll"]
         True
 
+      Coalescing fixed lines, see FormatFlowedDecoder, doesn't alter the
+      result:
+
+        >>> flowed = CRLF.join((
+        ... b"> Some code:",
+        ... b">",
+        ... b">     for line in lines:",
+        ... b">         print(line)",
+        ... b"",
+        ... b"The Mock Turtle"))
+        >>> for wrap_fixed in (True, False):
+        ...     result = convertToWrapped(flowed, 20, wrap_fixed=wrap_fixed,
+        ...                               coalesce_fixed=True)
+        ...     assert result == convertToWrapped(flowed, 20,
+        ...                                       wrap_fixed=wrap_fixed)
+        >>> result.split('\\n') == [
+        ...   "> Some code:",
+        ...   "> ",
+        ...   ">     for line in lines:",
+        ...   ">         print(line)",
+        ...   "",
+        ...   "The Mock Turtle"]
+        True
+
+      Nor does limiting the size of paragraph chunks; the parts of a
+      paragraph are wrapped as one:
+
+        >>> flowed = b'word \\r\\n' * 30 + b'end'
+        >>> result = convertToWrapped(flowed, 40, max_paragraph_chars=50)
+        >>> result == convertToWrapped(flowed, 40)
+        True
+
     """
     result = []
+    parts = []  # earlier parts of a paragraph, see max_paragraph_chars
     for info, chunk in decode(flowed, **kwargs):
         type = info['type']
+        if type == PARAGRAPH:
+            parts.append(chunk)
+            if info.get('continued'):
+                continue
+            chunk, parts = ''.join(parts), []
         quotedepth = info['quotedepth']
         quotemarker = quotedepth and quote * quotedepth or ''
         if quotemarker and quote[-1] != ' ':
             quotemarker += ' '
-        if type == FIXED and not wrap_fixed:
+        if type == FIXED and info.get('block'):
+            # a block of fixed lines, each displayed as a line of its own
+            lines = chunk.split('\n')
+            if not wrap_fixed:
+                result.extend(quotemarker + line for line in lines)
+                continue
+            wrapper = _TextWrapper(width, replace_whitespace=False,
+                                   initial_indent=quotemarker,
+                                   subsequent_indent=quotemarker)
+            for line in lines:
+                if line:
+                    result.extend(wrapper.wrap(line))
+                else:
+                    result.append(quotemarker)
+        elif type == FIXED and not wrap_fixed:
             result.append(quotemarker + chunk)
         elif not chunk or type == SIGNATURE_SEPARATOR:
             result.append(quotemarker + chunk)
         else:
-            result.extend(textwrap.wrap(chunk, width,
-                                        replace_whitespace=False,
-                                        initial_indent=quotemarker,
-                                        subsequent_indent=quotemarker))
+            wrapper = _TextWrapper(width, replace_whitespace=False,
+                                   initial_indent=quotemarker,
+                                   subsequent_indent=quotemarker)
+            result.extend(wrapper.wrap(chunk))
     return '\n'.join(result)
 
 
@@ -745,10 +2072,177 @@ def convertToFlowed(text, quotechars='>|%', **kwargs):
     return encoder.encode(_parseFlowableChunks(text, quotechars))
 
 
+def convertToHTML(flowed, stream=None, **kwargs):
+    """Convert flowed bytes to HTML
+
+    Renders the decoded text as an HTML fragment in a single pass over the
+    decoded chunks. Text is HTML-escaped, quoted text is placed in nested
+    blockquote elements, one per quote level, and lines are ended with line
+    breaks. Paragraphs are left to the browser to wrap, while FIXED lines
+    retain their spacing, with tabs expanded to spaces. The arguments are
+    interpreted as follows:
+      flowed
+        The format=flowed formatted bytestring to convert
+      stream (default: None)
+        A file-like object to write the HTML to. The HTML is written piece by
+        piece while decoding and None is returned. If not given, the HTML is
+        returned as a unicode string instead.
+
+      The remaining arguments are used as arguments to FormatFlowedDecoder.
+
+      Here is a simple example:
+
+        >>> CRLF = b'\\r\\n'
+        >>> result = convertToHTML(CRLF.join((
+        ... b"> `Take some more tea,' the March Hare said to Alice, very ",
+        ... b"> earnestly.",
+        ... b">",
+        ... b">> `I've had nothing yet,' Alice replied in an offended ",
+        ... b">> tone, `so I can't take more.'",
+        ... b"",
+        ... b"<Hatter>  You mean you can't take less & more",
+        ... b"-- ",
+        ... b"Lewis Caroll")))
+        >>> result.split('\\n') == [
+        ...   '<blockquote type="cite">'
+        ...   '`Take some more tea,&#x27; the March Hare said to Alice, '
+        ...   'very earnestly.<br />',
+        ...   '<br />',
+        ...   '<blockquote type="cite">'
+        ...   "`I&#x27;ve had nothing yet,&#x27; Alice replied in an offended "
+        ...   "tone, `so I can&#x27;t take more.&#x27;<br />",
+        ...   '</blockquote></blockquote><br />',
+        ...   "&lt;Hatter&gt;&nbsp; You mean you can&#x27;t take less &amp; "
+        ...   "more<br />",
+        ...   '-- <br />',
+        ...   'Lewis Caroll<br />',
+        ...   '']
+        True
+
+      Streaming the output to a file-like object:
+
+        >>> import io
+        >>> out = io.StringIO()
+        >>> convertToHTML(b'Hello, >> World!', stream=out)
+        >>> out.getvalue() == 'Hello, &gt;&gt; World!<br />\\n'
+        True
+
+      Indentation by tabs is kept:
+
+        >>> convertToHTML(b'\\tdef f():\\r\\n\\t\\treturn 1').split('\\n') == [
+        ...     '&nbsp;' * 7 + ' def f():<br />',
+        ...     '&nbsp;' * 15 + ' return 1<br />', '']
+        True
+
+    """
+    html = _iterHTML(decode(flowed, **kwargs))
+    if stream is None:
+        return ''.join(html)
+    write = stream.write
+    for piece in html:
+        write(piece)
+
+
 # -- Private classes and methods ---------------------------------------
 
 
-class _FlowedTextWrapper(textwrap.TextWrapper):
+def _hyphenatedLongWords():
+    # Newer versions of textwrap prefer to break long words after a hyphen
+    reversed_chunks, cur_line = ['ab-cdef'], []
+    textwrap.TextWrapper()._handle_long_word(reversed_chunks, cur_line, 0, 5)
+    return cur_line == ['ab-']
+
+
+_hyphenated_long_words = _hyphenatedLongWords()
+_whitespace_search = re.compile('\\s', flags=re.UNICODE).search
+_word_finditer = re.compile('\\S+', flags=re.UNICODE).finditer
+_first_word_match = re.compile('\\S*', flags=re.UNICODE).match
+_nonascii_space_search = re.compile('[^\\S\\x00-\\x7f]',
+                                    flags=re.UNICODE).search
+
+# Characters str.splitlines breaks lines on
+_linebreaks = '\n\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029'
+# Spaces and line breaks that end a word for all wrapper word separators
+_word_ends = ' \t' + _linebreaks
+_last_word_match = re.compile('.*\\S(?=[%s])' % _word_ends,
+                              flags=re.DOTALL | re.UNICODE).match
+# Paragraph text given in pieces is processed in windows of this many chars
+_window_size = 8192
+_text_type = type('')
+
+
+def _iterPieces(text):
+    """Iterate over paragraph text given as pieces, see encodeChunk
+
+    text is either an iterable of unicode strings, or a file-like object
+    opened in text mode, which is read in windows until a read returns
+    nothing:
+
+        >>> import io
+        >>> list(_iterPieces(io.StringIO('x' * 10000))) == [
+        ...     'x' * _window_size, 'x' * (10000 - _window_size)]
+        True
+
+    Files opened in binary mode are rejected, bar on Python 2, where files
+    opened in text mode return bytes as well:
+
+        >>> try:
+        ...     pieces = list(_iterPieces(io.BytesIO(b'tea')))
+        ... except TypeError as e:
+        ...     pieces = str(e)
+        >>> pieces == ([b'tea'] if bytes is str else
+        ...            'Cannot read paragraph text from a file in binary mode')
+        True
+
+    """
+    read = getattr(text, 'read', None)
+    if read is None:
+        return iter(text)
+    piece = read(_window_size)
+    if isinstance(piece, bytes) and bytes is not str:
+        raise TypeError(
+            'Cannot read paragraph text from a file in binary mode')
+    if not piece:
+        return iter(())
+    # stop on an empty read of the same type, Python 2 files return bytes
+    return chain([piece], iter(lambda: read(_window_size), piece[:0]))
+
+
+class _TextWrapper(textwrap.TextWrapper):
+    """Text wrapper breaking up long words in linear time
+
+    textwrap.TextWrapper breaks up a word that is too long to fit on a line
+    one line at a time, slicing off the remainder of the word for the next
+    line; wrapping a long unbreakable word is thus quadratic in its length.
+    This wrapper cuts such words into line-sized pieces in one go, producing
+    the same lines:
+
+        >>> wrapper = _TextWrapper(10, initial_indent='> ',
+        ...                        subsequent_indent='> ')
+        >>> wrapper.wrap('An ' + 'x' * 20 + ' word') == [
+        ...     '> An xxxxx', '> xxxxxxxx', '> xxxxxxx', '> word']
+        True
+
+    """
+    def _handle_long_word(self, reversed_chunks, cur_line, cur_len, width):
+        chunk = reversed_chunks[-1]
+        # Width left on the lines following the current line
+        step = self.width - len(self.subsequent_indent)
+        if (not self.break_long_words or width < 1 or step < 1 or
+                (_hyphenated_long_words and self.break_on_hyphens and
+                 '-' in chunk) or _whitespace_search(chunk)):
+            # Not breaking words, or the pieces would not fill their lines
+            return textwrap.TextWrapper._handle_long_word(
+                self, reversed_chunks, cur_line, cur_len, width)
+        end = width - cur_len
+        cur_line.append(chunk[:end])
+        pieces = [chunk[start:start + step]
+                  for start in range(end, len(chunk), step)]
+        pieces.reverse()
+        reversed_chunks[-1:] = pieces
+
+
+class _FlowedTextWrapper(_TextWrapper):
     """Custom text wrapper for flowed text
 
     When not using extra spaces, only break on spaces; when we are using
@@ -756,12 +2250,127 @@ class _FlowedTextWrapper(textwrap.TextWrapper):
     do break long words (as they can be reconstructed with DelSpace on).
 
     """
+    # Compiled once, wrappers are created for every paragraph
+    whitespace_wordsep_re = re.compile('(\\s+)', flags=re.UNICODE)
+
     def __init__(self, width=78, extra_space=False):
-        textwrap.TextWrapper.__init__(self, width,
-                                      break_long_words=extra_space)
+        _TextWrapper.__init__(self, width, break_long_words=extra_space,
+                              drop_whitespace=not extra_space)
         self.extra_space = extra_space
         if not extra_space:
-            self.wordsep_re = re.compile('(\\s+)', flags=re.UNICODE)
+            self.wordsep_re = self.whitespace_wordsep_re
+
+    def _splitPieces(self, pieces, strip=True):
+        """Split paragraph text given in pieces into lists of chunks
+
+        The chunks are those wrap would split the text into after replacing
+        line breaks with spaces, as the encoder does, and stripping trailing
+        whitespace if strip is set:
+
+            >>> wrapper = _FlowedTextWrapper(10, True)
+            >>> text = 'A wrapped  \\r\\nline-bre\\taking\\n\\t text \\n'
+            >>> chunks = wrapper._split(wrapper._munge_whitespace(
+            ...     ' '.join(text.rstrip().splitlines())))
+            >>> for size in range(1, len(text) + 1):
+            ...     pieces = [text[i:i + size]
+            ...               for i in range(0, len(text), size)]
+            ...     batches = list(wrapper._splitPieces(pieces))
+            ...     assert sum(batches, []) == chunks, size
+
+        Text is only split up to the last word followed by a space or line
+        break in each window of pieces, as later pieces can continue the
+        word or the whitespace after it.
+
+        """
+        tabsize = getattr(self, 'tabsize', 8)
+        window, size = [], 0
+        pending = []  # text after the last word end, not yet split
+        column = 0
+        for piece in chain(pieces, [None]):
+            if piece is not None:
+                window.append(piece)
+                size += len(piece)
+                if size < _window_size:
+                    continue
+            text = ''.join(window)
+            window, size = [], 0
+            if piece is None:
+                text = ''.join(pending) + text
+                if strip:
+                    text = text.rstrip()
+            else:
+                match = _last_word_match(text)
+                if match is not None:
+                    end = match.end()
+                elif (text[:1] and text[0] in _word_ends and pending and
+                        not _whitespace_search(pending[-1][-1])):
+                    end = 0
+                else:
+                    if text:
+                        pending.append(text)
+                    continue
+                pending.append(text[:end])
+                text, pending = ''.join(pending), [text[end:]]
+
+            text = ' '.join(text.splitlines())
+            if self.expand_tabs and '\t' in text:
+                # expand tabs as if preceded by the text split so far
+                pad = column % tabsize
+                text = (' ' * pad + text).expandtabs(tabsize)[pad:]
+            column += len(text)
+            yield self._split(self._munge_whitespace(text))
+
+    def _wrapPieces(self, pieces, strip=True):
+        """Wrap paragraph text given in pieces, yielding lines as they fill
+
+        Produces the same lines as wrapping the joined text, see
+        _splitPieces, without ever joining the whole text:
+
+            >>> wrapper = _FlowedTextWrapper(10)
+            >>> text = 'Some text  with\\nline breaks, and a verylongword. '
+            >>> list(wrapper._wrapPieces(text)) == wrapper.wrap(
+            ...     ' '.join(text.rstrip().splitlines()))
+            True
+
+        """
+        # Greedy line filling as in textwrap.TextWrapper._wrap_chunks, with
+        # the reversed chunk stack refilled from the next batch when empty
+        batches = self._splitPieces(pieces, strip)
+        width, drop_whitespace = self.width, self.drop_whitespace
+        chunks = []
+        started = False
+        while True:
+            cur_line = []
+            cur_len = 0
+            if not chunks:
+                chunks = _nextStack(batches)
+                if not chunks:
+                    return
+
+            if drop_whitespace and chunks[-1].strip() == '' and started:
+                del chunks[-1]
+
+            while True:
+                if not chunks:
+                    chunks = _nextStack(batches)
+                    if not chunks:
+                        break
+                l = len(chunks[-1])
+                if cur_len + l <= width:
+                    cur_line.append(chunks.pop())
+                    cur_len += l
+                else:
+                    break
+
+            if chunks and len(chunks[-1]) > width:
+                self._handle_long_word(chunks, cur_line, cur_len, width)
+
+            if drop_whitespace and cur_line and cur_line[-1].strip() == '':
+                del cur_line[-1]
+
+            if cur_line:
+                started = True
+                yield ''.join(cur_line)
 
     def _wrap(self, chunks):
         # Simplified and customized version of textwrap.TextWrapper
@@ -800,6 +2409,657 @@ class _FlowedTextWrapper(textwrap.TextWrapper):
         return lines
 
 
+def _nextStack(batches):
+    """Return the next non-empty batch of chunks reversed, or [] if none"""
+    for batch in batches:
+        if batch:
+            batch.reverse()
+            return batch
+    return []
+
+
+_html_escapes = {
+    ord('&'): '&amp;',
+    ord('<'): '&lt;',
+    ord('>'): '&gt;',
+    ord('"'): '&quot;',
+    ord("'"): '&#x27;',
+}
+
+# Spaces that HTML would otherwise collapse: leading or followed by a space
+_html_nbsp_sub = re.compile('^ | (?= )').sub
+
+
+def _iterHTML(chunks):
+    """Generate HTML for decoded chunks of text, see convertToHTML
+
+    Each chunk is rendered as it is consumed; quote depth changes open and
+    close blockquotes:
+
+        >>> ''.join(_iterHTML((
+        ...     ({'type': FIXED, 'quotedepth': 2}, '    indented'),
+        ...     ({'type': PARAGRAPH, 'quotedepth': 0}, 'Unquoted'),
+        ... ))) == (
+        ...     '<blockquote type="cite"><blockquote type="cite">'
+        ...     '&nbsp;&nbsp;&nbsp; indented<br />\\n'
+        ...     '</blockquote></blockquote>Unquoted<br />\\n')
+        True
+
+    The lines of a fixed block each end in a line break, and have their tabs
+    expanded line by line:
+
+        >>> ''.join(_iterHTML((
+        ...     ({'type': FIXED, 'quotedepth': 0, 'block': True},
+        ...      'if x:\\n  return 1\\n\\tpass'),
+        ... ))) == ('if x:<br />\\n&nbsp; return 1<br />\\n' +
+        ...         '&nbsp;' * 7 + ' pass<br />\\n')
+        True
+
+    Paragraphs continued in the next chunk are not ended with a line break:
+
+        >>> ''.join(_iterHTML((
+        ...     ({'type': PARAGRAPH, 'quotedepth': 0, 'continued': True},
+        ...      'A long '),
+        ...     ({'type': PARAGRAPH, 'quotedepth': 0}, 'paragraph'),
+        ... ))) == 'A long paragraph<br />\\n'
+        True
+
+    """
+    depth = 0
+    for info, chunk in chunks:
+        quotedepth = info['quotedepth']
+        if quotedepth != depth:
+            if quotedepth > depth:
+                yield '<blockquote type="cite">' * (quotedepth - depth)
+            else:
+                yield '</blockquote>' * (depth - quotedepth)
+            depth = quotedepth
+        type = info['type']
+        if type == FIXED:
+            # tabs would collapse like any other whitespace
+            chunk = chunk.expandtabs()
+        chunk = chunk.translate(_html_escapes)
+        if type == FIXED and info.get('block'):
+            for line in chunk.split('\n'):
+                yield _html_nbsp_sub('&nbsp;', line) + '<br />\n'
+        elif type == FIXED:
+            yield _html_nbsp_sub('&nbsp;', chunk) + '<br />\n'
+        elif type == PARAGRAPH and info.get('continued'):
+            yield chunk
+        else:
+            yield chunk + '<br />\n'
+    if depth:
+        yield '</blockquote>' * depth
+
+
+# Typecodes for arrays of text offsets, smallest items first; these must be
+# native strings on Python 2
+_offset_typecodes = (str('H'), str('I'), str('L'))
+
+
+def _offsetArray(length):
+    """Create an empty array for offsets into a text of the given length
+
+    The array uses the smallest item size that holds the offsets:
+
+        >>> _offsetArray(1000).itemsize
+        2
+        >>> _offsetArray(100000).itemsize >= 4
+        True
+
+    """
+    for typecode in _offset_typecodes:
+        offsets = array(typecode)
+        if length < 1 << 8 * offsets.itemsize:
+            return offsets
+    return offsets
+
+
+def _wrapTokens(chunk, text, ends, blanks, width, indent):
+    """Wrap text pre-split into tokens, see FormatFlowedDocument
+
+    chunk is wrapped like _TextWrapper would, with replace_whitespace off and
+    using indent as the initial and subsequent indent. Instead of splitting
+    the text, the (munged) text and the end offsets of its tokens are used,
+    as well as a flag for each token telling if it consists of whitespace
+    only. Whole lines are sliced out of the text, finding the last token that
+    fits on each line by bisecting the offsets:
+
+        >>> text = 'Wrapping pre-split text'
+        >>> ends = _offsetArray(len(text))
+        >>> ends.extend([8, 9, 13, 18, 19, 23])
+        >>> blanks = bytearray([0, 1, 0, 0, 1, 0])
+        >>> _wrapTokens(text, text, ends, blanks, 12, '> ') == [
+        ...     '> Wrapping', '> pre-split', '> text']
+        True
+
+    """
+    width -= len(indent)
+    if width < 1:
+        # Degenerate case, leave it to the wrapper
+        wrapper = _TextWrapper(width + len(indent), replace_whitespace=False,
+                               initial_indent=indent, subsequent_indent=indent)
+        return wrapper.wrap(chunk)
+
+    def blank(index, pos):
+        if pos == (index and ends[index - 1]):
+            return blanks[index]
+        return not text[pos:ends[index]].strip()  # remainder of a long word
+
+    lines = []
+    count = len(ends)
+    index, pos = 0, 0
+    while index < count:
+        # Drop whitespace at the start of all but the first line
+        if lines and blank(index, pos):
+            pos = ends[index]
+            index += 1
+            if index == count:
+                break
+
+        # Take all tokens that fit, tracking the last piece of the line
+        start, tail = pos, None
+        last = bisect_right(ends, start + width, index)
+        if last > index:
+            tail = last - 1 > index and ends[last - 2] or start
+            tailblank = blank(last - 1, tail)
+            index, pos = last, ends[last - 1]
+        if index < count and ends[index] - pos > width:
+            # Break up a word that is too long to fit on any line
+            end = start + width
+            if _hyphenated_long_words:
+                hyphen = text.rfind('-', pos, end)
+                if hyphen > pos and text[pos:hyphen].strip('-'):
+                    end = hyphen + 1
+            tail, tailblank = pos, not text[pos:end].strip()
+            pos = end
+
+        # Drop whitespace at the end of the line
+        linend = tail if tail is not None and tailblank else pos
+        if linend > start:
+            lines.append(indent + text[start:linend])
+    return lines
+
+
+def _reflowUnchanged(flowed, from_options, to_options):
+    """Test if reflow can copy flowed bytes as they are
+
+    That is the case if re-encoding the decoded text would produce the same
+    lines, which is checked line by line: every line must be stuffed and
+    every fixed line cleaned up as the encoder does, while the lines of each
+    paragraph must be exactly those the encoder would wrap it into, all
+    fitting the width but full enough that the next word does not fit:
+
+        >>> _reflowUnchanged(b'Some text \\r\\nwrapped', DecoderOptions(),
+        ...                  EncoderOptions(width=11))
+        True
+        >>> _reflowUnchanged(b'Some text \\r\\nwrapped', DecoderOptions(),
+        ...                  EncoderOptions(width=10))
+        False
+        >>> _reflowUnchanged(b'Some text \\r\\nwrapped', DecoderOptions(),
+        ...                  EncoderOptions(width=20))
+        False
+        >>> _reflowUnchanged(b'Some text  \\r\\nwrapped',
+        ...                  DecoderOptions(delete_space=True),
+        ...                  EncoderOptions(width=12, extra_space=True))
+        True
+        >>> _reflowUnchanged(b'Some text \\r\\nwrapped',
+        ...                  DecoderOptions(delete_space=True),
+        ...                  EncoderOptions())
+        False
+        >>> _reflowUnchanged(b'Caf\\xc3\\xa9', DecoderOptions(),
+        ...                  EncoderOptions(character_set='utf-8'))
+        False
+
+    Lines that need stuffing must be stuffed, and only those:
+
+        >>> _reflowUnchanged(b' From here on', DecoderOptions(),
+        ...                  EncoderOptions())
+        True
+        >>> _reflowUnchanged(b'From here on', DecoderOptions(),
+        ...                  EncoderOptions())
+        False
+        >>> _reflowUnchanged(b' here on', DecoderOptions(), EncoderOptions())
+        False
+
+    """
+    if (from_options.delete_space != to_options.extra_space or
+            from_options.max_paragraph_chars):
+        return False
+    character_set = from_options.character_set
+    try:
+        if (codecs.lookup(character_set).name !=
+                codecs.lookup(to_options.character_set).name):
+            return False
+    except LookupError:
+        return False
+    decoder = FormatFlowedDecoder(options=from_options)
+    encoder = FormatFlowedEncoder(options=to_options)
+    extra_space = to_options.extra_space
+    forcestuff = to_options.spacestuff_quoted
+    split = _FlowedTextWrapper(extra_space=extra_space)._split
+    # quotedepth, wrapping width and words of the last line if it is flowed
+    previous = None
+    for encoded in _splitlines(flowed):
+        if len(encoded) > 998:
+            return False
+        try:
+            line = encoded.decode(character_set)
+        except UnicodeDecodeError:
+            return False
+        quotedepth, line = decoder._stripquotes(line)
+        text = decoder._stripstuffing(line)
+        if encoder._spacestuff(text, forcestuff and quotedepth > 0) != line:
+            return False
+        flows = text.endswith(' ') and text != '-- '
+        if previous is None:
+            if not flows:
+                # a fixed line or signature separator; encoded as it is
+                if (text != '-- ' and
+                        text != ' '.join(text.rstrip().splitlines())):
+                    return False
+                continue
+            width = (to_options.width - 2 -
+                     len(('>' * quotedepth).encode(character_set)))
+        else:
+            depth, width, words = previous
+            if quotedepth != depth or text == '-- ':
+                # a paragraph ended early, without its last line
+                return False
+        # The text of the line as the wrapper produced it. Without
+        # extra_space, the whitespace between lines was dropped and the
+        # paragraph's last line is stripped with both.
+        words = text[:-1] if flows else text
+        if '\t' in words or words.splitlines() != [words]:
+            # tabs are expanded and line breaks replaced
+            return False
+        if (not (extra_space and flows) and words != words.rstrip() or
+                not extra_space and previous is not None and
+                words != words.lstrip()):
+            return False
+        if len(words) > width and (extra_space or
+                                   _whitespace_search(words)):
+            # only a single word, that isn't broken, can exceed the width
+            return False
+        if previous is not None:
+            # the line must start where the wrapper splits the text, with a
+            # word (part) that does not fit the previous line
+            if extra_space:
+                before = previous[2]
+                first = _firstChunk(split, before, words)
+                if first is None:
+                    return False
+            else:
+                before = previous[2] + ' '
+                first = _first_word_match(words).group()
+            if len(before) + len(first) <= width:
+                return False
+        previous = (quotedepth, width, words) if flows else None
+    return previous is None
+
+
+def _firstChunk(split, before, text):
+    """Split text following before, returning its first chunk
+
+    Returns None if the wrapper's split doesn't start a chunk at the start
+    of text:
+
+        >>> split = _FlowedTextWrapper(extra_space=True)._split
+        >>> _firstChunk(split, 'a well-', 'known word') == 'known'
+        True
+        >>> _firstChunk(split, 'a we', 'll-known word') is None
+        True
+
+    """
+    # Chunks never span whitespace and the next chunk starts right after it,
+    # so splitting from the last whitespace run or word of before onwards,
+    # up to a character past the first whitespace in text, is enough.
+    stripped = before.rstrip()
+    if stripped != before:
+        before = before[len(stripped):]
+    elif before:
+        before = before.rsplit(None, 1)[-1]
+    space = _whitespace_search(text)
+    if space is not None:
+        end = space.start() or len(text) - len(text.lstrip())
+        text = text[:end + 1]
+    start = 0
+    for chunk in split(before + text):
+        if start == len(before):
+            return chunk
+        if start > len(before):
+            break
+        start += len(chunk)
+    return None
+
+
+def _fixedChunk(lines, quotedepth):
+    """Build the decoded chunk for a run of fixed lines, see decode
+
+        >>> _fixedChunk(['one'], 1) == (
+        ...     {'type': FIXED, 'quotedepth': 1}, 'one')
+        True
+        >>> _fixedChunk(['one', 'two'], 0) == (
+        ...     {'type': FIXED, 'quotedepth': 0, 'block': True}, 'one\\ntwo')
+        True
+
+    """
+    if len(lines) == 1:
+        return ({'type': FIXED, 'quotedepth': quotedepth}, lines[0])
+    return ({'type': FIXED, 'quotedepth': quotedepth, 'block': True},
+            '\n'.join(lines))
+
+
+# Texts are decoded with NumPy in windows of this many bytes, or more if a
+# chunk needs it; smaller texts decode faster line by line
+_vector_window = 65536
+
+
+def _vectorCharset(character_set):
+    """Return the codec name of a character set NumPy decoding can handle
+
+    That is UTF-8 and the single byte character sets extending ASCII; in
+    others, the bytes of CR, LF, space, '>' or '-' may be (part of) other
+    characters. Returns None for other character sets:
+
+        >>> _vectorCharset('UTF8'), _vectorCharset('latin-1')
+        ('utf-8', 'iso8859-1')
+        >>> _vectorCharset('shift_jis'), _vectorCharset('cp037')
+        (None, None)
+
+    """
+    name = codecs.lookup(character_set).name
+    if name != 'utf-8':
+        ascii = bytes(bytearray(range(128)))
+        table = (ascii + bytes(bytearray(range(128, 256)))).decode(
+            name, 'replace')
+        if len(table) != 256 or table[:128] != ascii.decode('ascii'):
+            return None
+    return name
+
+
+def _vectorWindows(flowed, window, fallback):
+    """Process flowed bytes window by window with NumPy
+
+    window(data, offset, final) is passed a NumPy array of the bytes from
+    offset on, starting at a line that starts a chunk, and returns an
+    iterable of items and the number of bytes they take; when final is set,
+    that is all of data. It returns None instead if it can't process the
+    text, which is then passed to fallback(offset), returning an iterable of
+    items for the rest of the text. Yields the iterables of items.
+
+    """
+    data = numpy.frombuffer(flowed, dtype=numpy.uint8)
+    start, size = 0, _vector_window
+    while start < len(flowed):
+        result = window(data[start:start + size], start,
+                        start + size >= len(flowed))
+        if result is None:
+            yield fallback(start)
+            return
+        items, taken = result
+        yield items
+        # grow the window if no chunk fit in it
+        start, size = start + taken, _vector_window if taken else size * 2
+
+
+def _vectorLines(data, options, final):
+    """Classify the lines of a window of flowed bytes with NumPy
+
+    Rather than classifying the text line by line, the lines of data, a
+    NumPy uint8 array starting at a line that starts a chunk, are classified
+    with array operations. The runs of lines that form a chunk follow from
+    the flow, quotedepth and signature separator flags of consecutive lines.
+
+    Returns arrays of the starts of the lines, the starts and ends of their
+    texts, their quotedepths and types, and the flags for lines that join
+    the line before them in a paragraph and in a block. Then follow the
+    indices of the lines starting chunks, and the number of lines in those
+    chunks, which is 0 if no chunk is complete. Unless final is set, the
+    last line may go on past the window, and with it its chunk; the line
+    starting the last chunk is left out, but its text start and end are
+    included, to make sure it does start a chunk.
+
+    Returns None if the text could classify differently line by line, as it
+    has empty flowed lines, that don't end paragraphs when deleting flow
+    spaces.
+
+    """
+    size = len(data)
+    crlf = numpy.flatnonzero((data[:-1] == 13) & (data[1:] == 10))
+    starts = numpy.concatenate(([0], crlf + 2))
+    ends = numpy.concatenate((crlf, [size]))
+    count = len(starts)
+
+    # Quotemarks are the runs of '>' bytes at the start of lines
+    depths = numpy.zeros(count, dtype=starts.dtype)
+    marks = numpy.flatnonzero(data == 62)
+    if len(marks):
+        runs = numpy.flatnonzero(numpy.diff(marks) != 1) + 1
+        run_starts = marks[numpy.concatenate(([0], runs))]
+        run_ends = marks[numpy.concatenate((runs - 1, [-1]))] + 1
+        run = numpy.minimum(numpy.searchsorted(run_starts, starts),
+                            len(run_starts) - 1)
+        quoted = run_starts[run] == starts
+        depths[quoted] = (numpy.minimum(run_ends[run[quoted]], ends[quoted]) -
+                          starts[quoted])
+    text = starts + depths
+    stuffed = text < ends
+    stuffed[stuffed] = data[text[stuffed]] == 32
+    text += stuffed
+
+    # Flowed lines end in a space, signature separators are '-- '
+    last = numpy.zeros(count, dtype=data.dtype)
+    filled = text < ends
+    last[filled] = data[ends[filled] - 1]
+    separator = ends - text == 3
+    separator[separator] = ((data[text[separator]] == 45) &
+                            (data[text[separator] + 1] == 45) &
+                            (last[separator] == 32))
+    flows = (last == 32) & ~separator
+    types = numpy.where(separator, SIGNATURE_SEPARATOR,
+                        numpy.where(flows, PARAGRAPH, FIXED))
+    if options.delete_space:
+        ends = ends - flows
+
+    # A line joins the chunk of the line before it if that line flowed at
+    # the same quotedepth, or if both are fixed lines of a block
+    samedepth = depths[1:] == depths[:-1]
+    joins = numpy.zeros(count, dtype=bool)
+    joins[1:] = flows[:-1] & samedepth & ~separator[1:]
+    blocks = numpy.zeros(count, dtype=bool)
+    if options.coalesce_fixed:
+        single = (types == FIXED) & ~joins
+        feeds = numpy.flatnonzero(data == 10)
+        feeds = feeds[(feeds == 0) | (data[feeds - 1] != 13)]
+        # a bare LF in a line would be taken for a block line break
+        single[numpy.searchsorted(starts, feeds, 'right') - 1] = False
+        blocks[1:] = single[1:] & single[:-1] & samedepth
+    first = numpy.flatnonzero(~(joins | blocks))
+
+    used = count
+    if not final:
+        first = first[first < count - 1]
+        if len(first) < 2:
+            return starts, text, ends, depths, types, joins, blocks, first, 0
+        first, used = first[:-1], first[-1]
+    text, ends = text[:used + 1], ends[:used + 1]
+    if options.delete_space and (ends == text)[flows[:used + 1]].any():
+        return None
+    return starts, text, ends, depths, types, joins, blocks, first, used
+
+
+def _vectorKeep(data, starts, text, ends, feeds):
+    """Select the texts of the lines of a window, see _vectorLines
+
+    Drops the quotemarks, stuffing, line breaks and deleted flow spaces
+    between the texts, except for the LFs ending the line breaks before the
+    lines flagged in feeds. Returns the bytes kept, and their indices in
+    data.
+
+    """
+    lines = len(text)
+    limit = starts[lines] - 2 if lines < len(starts) else len(data)
+    gap_starts = numpy.concatenate(([0], ends))
+    gaps = numpy.append(text, limit) - gap_starts
+    keep = numpy.ones(limit, dtype=bool)
+    keep[numpy.repeat(gap_starts - numpy.cumsum(gaps) + gaps, gaps) +
+         numpy.arange(gaps.sum())] = False
+    keep[starts[1:lines][feeds[1:lines]] - 1] = True
+    indices = numpy.flatnonzero(keep)
+    return data[indices], indices
+
+
+def _vectorWindow(data, options, character_set, final):
+    """Decode a window of flowed bytes with NumPy, see FormatFlowedDecoder
+
+    The lines of data are classified by _vectorLines, and the texts of the
+    lines decoded once, to be sliced into chunks. Returns the chunks decode
+    produces for the lines of complete chunks, and the number of bytes they
+    take, see _vectorWindows. Returns None if the text could decode
+    differently line by line: when it doesn't decode without errors, so
+    that any error handler gives the same text, or when _vectorLines can't
+    classify it.
+
+    """
+    lines = _vectorLines(data, options, final)
+    if lines is None:
+        return None
+    starts, text, ends, depths, types, joins, blocks, first, used = lines
+    if not used:
+        return [], 0
+    blocks = blocks[:len(text)]
+    kept, indices = _vectorKeep(data, starts, text, ends, blocks)
+    try:
+        decoded = kept.tobytes().decode(character_set)
+    except UnicodeDecodeError:
+        return None
+    offsets = numpy.concatenate(([0], numpy.cumsum(ends - text + blocks)))
+    if len(decoded) != len(kept):
+        # Lines that decode on their own don't start with UTF-8 continuation
+        # bytes; count characters rather than bytes
+        if ((data[text[text < ends]] & 0xc0) == 0x80).any():
+            return None
+        continuations = numpy.flatnonzero((kept & 0xc0) == 0x80)
+        offsets -= numpy.searchsorted(continuations, offsets)
+
+    isblock = numpy.append(blocks[1:], False)[first]
+    chunks = []
+    for type, quotedepth, block, start, end in zip(
+            types[first].tolist(), depths[first].tolist(), isblock.tolist(),
+            offsets[first].tolist(),
+            offsets[numpy.append(first[1:], used)].tolist()):
+        info = {'type': type, 'quotedepth': quotedepth}
+        if block:
+            info['block'] = True
+        chunks.append((info, decoded[start:end]))
+    return chunks, int(len(data) if used == len(starts) else starts[used])
+
+
+def _vectorTokens(data, offset, options, character_set, spaces, final):
+    """Find the words in a window of flowed bytes with NumPy, see iterTokens
+
+    The lines of data are classified by _vectorLines, and the texts of the
+    lines decoded once, with an LF between chunks, to be split into words.
+    Where the words start and end in data follows from the runs of bytes
+    that are not flagged in spaces, an array flagging the bytes that decode
+    to whitespace. Returns the tokens iterTokens produces for the lines of
+    complete chunks, with offset added to their offsets, and the number of
+    bytes they take, see _vectorWindows. Returns None if the text could be
+    tokenized differently line by line, see _vectorWindow, or has whitespace
+    characters that take more than one byte. The tokens are the same as
+    those found line by line; here the no-break spaces at the end are
+    tokenized line by line, from the start of their window on:
+
+        >>> flowed = (b'> Un \\r\\n> ex \\r\\n> cept \\r\\n> ional.\\r\\n'
+        ...           b'caf\\xc3\\xa9 au \\r\\n\\tlait\\r\\n-- \\r\\n' * 5000 +
+        ...           b'\\xc2\\xa0\\xc2\\xa0')
+        >>> for delete_space in (False, True):
+        ...     options = DecoderOptions(delete_space, 'utf-8')
+        ...     tokens = list(iterTokens(flowed, options=options))
+        ...     assert tokens == list(chain.from_iterable(_lineTokens(
+        ...         flowed, options, b' '))), delete_space
+        >>> tokens[-2:] == [('au', 0, len(flowed) - 21, len(flowed) - 19),
+        ...                 ('lait', 0, len(flowed) - 15, len(flowed) - 11)]
+        True
+
+    """
+    lines = _vectorLines(data, options, final)
+    if lines is None:
+        return None
+    starts, text, ends, depths, types, joins, blocks, first, used = lines
+    if not used:
+        return [], 0
+    # signature separators are not words
+    ends = numpy.where(types[:len(text)] == SIGNATURE_SEPARATOR, text, ends)
+    kept, indices = _vectorKeep(data, starts, text, ends, ~joins)
+    try:
+        decoded = kept.tobytes().decode(character_set)
+    except UnicodeDecodeError:
+        return None
+    if len(decoded) != len(kept) and (
+            ((data[text[text < ends]] & 0xc0) == 0x80).any() or
+            _nonascii_space_search(decoded)):
+        # UTF-8 characters span lines, see _vectorWindow, or are whitespace
+        return None
+    words = decoded.split()
+
+    # the edges of runs of word bytes, alternating starts and ends
+    inword = numpy.concatenate(([False], ~spaces[kept], [False]))
+    edges = numpy.flatnonzero(inword[1:] != inword[:-1])
+    wordstarts = indices[edges[::2]]
+    wordends = indices[edges[1::2] - 1] + 1
+    if used < len(starts):
+        # drop the words of the line starting the next chunk
+        count = numpy.searchsorted(wordstarts, starts[used])
+        del words[count:]
+        wordstarts, wordends = wordstarts[:count], wordends[:count]
+    quotedepths = depths[numpy.searchsorted(starts, wordstarts, 'right') - 1]
+    return (zip(words, quotedepths.tolist(), (wordstarts + offset).tolist(),
+                (wordends + offset).tolist()),
+            int(len(data) if used == len(starts) else starts[used]))
+
+
+def _vectorSpaces(character_set):
+    """Flag the bytes decoding to whitespace in a _vectorCharset
+
+        >>> numpy is None or [byte for byte in range(256)
+        ...                   if _vectorSpaces('latin-1')[byte]] == [
+        ...     9, 10, 11, 12, 13, 28, 29, 30, 31, 32, 133, 160]
+        True
+
+    In UTF-8, only ASCII characters are encoded as single bytes.
+
+    """
+    table = bytes(bytearray(range(128))).decode('ascii')
+    if character_set != 'utf-8':
+        table += bytes(bytearray(range(128, 256))).decode(character_set,
+                                                          'replace')
+    return numpy.array([char.isspace() for char in table] +
+                       [False] * (256 - len(table)))
+
+
+def _splitlines(flowed):
+    """Iterate over the CRLF delimited lines of a bytestring
+
+    Produces the same lines as flowed.split(b'\\r\\n') would, but without
+    building a list of all lines up front:
+
+        >>> list(_splitlines(b'one\\r\\ntwo\\r\\n')) == [b'one', b'two', b'']
+        True
+
+    """
+    find = flowed.find
+    start = 0
+    while True:
+        end = find(b'\r\n', start)
+        if end < 0:
+            yield flowed[start:]
+            return
+        yield flowed[start:end]
+        start = end + 2
+
+
 def _parseFlowableChunks(text, quotechars='>|%'):
     """Parse out encodeble chunks, determining chunk type
 
@@ -869,7 +3129,7 @@ def _parseFlowableChunks(text, quotechars='>|%'):
 
     quotedepth = 0
     quotemarks = ''
-    para = ''
+    para = []
 
     for line in text.splitlines():
         has_quotes = qm_match(line)
@@ -877,8 +3137,9 @@ def _parseFlowableChunks(text, quotechars='>|%'):
         if (has_quotes and not same_quotes) or (not has_quotes and quotedepth):
             # Change in quoting
             if para:
-                yield {'type': PARAGRAPH, 'quotedepth': quotedepth}, para
-                para = ''
+                yield ({'type': PARAGRAPH, 'quotedepth': quotedepth},
+                       ''.join(para))
+                para = []
 
             quotemarks = has_quotes and has_quotes.group(0) or ''
             quotedepth = len(qm_findall(quotemarks))
@@ -888,8 +3149,9 @@ def _parseFlowableChunks(text, quotechars='>|%'):
         if line.rstrip() == '--':
             # signature separator
             if para:
-                yield {'type': PARAGRAPH, 'quotedepth': quotedepth}, para
-                para = ''
+                yield ({'type': PARAGRAPH, 'quotedepth': quotedepth},
+                       ''.join(para))
+                para = []
 
             yield {'type': SIGNATURE_SEPARATOR, 'quotedepth': quotedepth}, line
             continue
@@ -897,17 +3159,560 @@ def _parseFlowableChunks(text, quotechars='>|%'):
         if line.strip() == '' or line.lstrip() != line:
             # Fixed line
             if para:
-                yield {'type': PARAGRAPH, 'quotedepth': quotedepth}, para
-                para = ''
+                yield ({'type': PARAGRAPH, 'quotedepth': quotedepth},
+                       ''.join(para))
+                para = []
 
             yield {'type': FIXED, 'quotedepth': quotedepth}, line
             continue
 
         # Paragraph line; store and loop to next line
-        para += line
+        para.append(line)
 
     if para:
-        yield {'type': PARAGRAPH, 'quotedepth': quotedepth}, para
+        yield {'type': PARAGRAPH, 'quotedepth': quotedepth}, ''.join(para)
+
+
+def _scalesLinearly(func, make_input, size, repeat=3):
+    """Test if func time and memory use grow (near) linearly with input size
+
+    make_input(n) creates an input for func that grows linearly with n. func
+    is run on inputs for n = size, 2 * size, 4 * size and 8 * size, and both
+    its running time and, where tracemalloc is available, its peak memory use
+    are measured. The smaller inputs are run repeatedly, so that every timing
+    covers the same amount of input. Returns True if neither grows more than
+    three times faster than the input does; quadratic algorithms grow eight
+    times faster. Where the quadratic part of an algorithm is only copying
+    memory it takes large inputs to dominate the running time, hence the
+    sizes of the long line tests below.
+
+    These tests guard the public entry points against regressions to
+    quadratic behaviour:
+
+    - decoding huge paragraphs, many quotedepth changes and long fixed lines:
+
+        >>> _scalesLinearly(lambda flowed: list(decode(flowed)),
+        ...                 lambda n: b'word \\r\\n' * n + b'end', 500)
+        True
+        >>> _scalesLinearly(
+        ...     lambda flowed: list(decode(flowed, max_paragraph_chars=500)),
+        ...     lambda n: b'word \\r\\n' * n + b'end', 500)
+        True
+        >>> _scalesLinearly(lambda flowed: list(decode(flowed)),
+        ...                 lambda n: b'> word \\r\\n>> word \\r\\n' * n, 250)
+        True
+        >>> _scalesLinearly(lambda flowed: list(decode(flowed)),
+        ...                 lambda n: b'-' * 10000 * n, 40)
+        True
+
+    - encoding huge paragraphs, including identical wrapped lines, many
+      quotedepth changes, long unbreakable words and long fixed lines. The
+      textwrap module of Python 2 takes quadratic time to split long words,
+      so these are only tested on Python 3:
+
+        >>> _scalesLinearly(encode, lambda n: [
+        ...     ({'type': PARAGRAPH, 'quotedepth': 0}, 'word ' * n)], 1000)
+        True
+        >>> _scalesLinearly(encode, lambda n: [
+        ...     ({'type': PARAGRAPH, 'quotedepth': depth % 3}, 'word word')
+        ...     for depth in range(n)], 250)
+        True
+        >>> import sys
+        >>> sys.version_info < (3,) or _scalesLinearly(
+        ...     lambda chunks: encode(chunks, extra_space=True),
+        ...     lambda n: [({'type': PARAGRAPH, 'quotedepth': 0},
+        ...                 'x' * 10000 * n)], 20)
+        True
+        >>> _scalesLinearly(encode, lambda n: [
+        ...     ({'type': FIXED, 'quotedepth': 0}, '-' * 10000 * n)], 40)
+        True
+
+    - scanning:
+
+        >>> _scalesLinearly(scan, lambda n: b'> word \\r\\n>> word \\r\\n' * n,
+        ...                 250)
+        True
+
+    - reflowing, both re-encoding and copying the bytes:
+
+        >>> _scalesLinearly(
+        ...     lambda flowed: reflow(flowed, to_options=EncoderOptions(
+        ...         width=30, extra_space=True)),
+        ...     lambda n: b'> some more words \\r\\n' * n + b'> end', 250)
+        True
+        >>> _scalesLinearly(reflow, lambda n: b'> some words\\r\\n' * n, 1000)
+        True
+        >>> _scalesLinearly(
+        ...     reflow, lambda n: convertToFlowed('some words ' * n), 1000)
+        True
+
+    - tokenizing, including a single word flowed over many lines:
+
+        >>> _scalesLinearly(lambda flowed: list(iterTokens(flowed)),
+        ...                 lambda n: b'> some words \\r\\n' * n, 250)
+        True
+        >>> _scalesLinearly(
+        ...     lambda flowed: list(iterTokens(flowed, delete_space=True)),
+        ...     lambda n: b'> part \\r\\n' * n, 250)
+        True
+
+    - converting to and from wrapped text:
+
+        >>> _scalesLinearly(convertToWrapped,
+        ...                 lambda n: b'word \\r\\n' * n + b'end', 500)
+        True
+        >>> sys.version_info < (3,) or _scalesLinearly(
+        ...     convertToWrapped, lambda n: b'x' * 10000 * n, 20)
+        True
+        >>> _scalesLinearly(convertToFlowed,
+        ...                 lambda n: 'word \\n' * n, 500)
+        True
+        >>> _scalesLinearly(convertToFlowed,
+        ...                 lambda n: '> word\\n>> word\\n' * n, 125)
+        True
+
+    - converting to HTML:
+
+        >>> _scalesLinearly(convertToHTML,
+        ...                 lambda n: b'word \\r\\n' * n + b'end', 500)
+        True
+        >>> _scalesLinearly(convertToHTML,
+        ...                 lambda n: b'> word \\r\\n>> word \\r\\n' * n, 250)
+        True
+
+    """
+    import gc
+    import time
+    import timeit
+    try:
+        import tracemalloc
+    except ImportError:  # Python < 3.4
+        tracemalloc = None
+
+    factors = (1, 2, 4, 8)
+    inputs = [make_input(size * factor) for factor in factors]
+    # Measure processor time where available, other processes skew wall time
+    timer = getattr(time, 'process_time', timeit.default_timer)
+    timings, peaks = [], []
+    gcenabled = gc.isenabled()
+    gc.disable()
+    try:
+        for factor, data in zip(factors, inputs):
+            runs = range(factors[-1] // factor)
+            best = None
+            for i in range(repeat):
+                start = timer()
+                for run in runs:
+                    func(data)
+                elapsed = timer() - start
+                if best is None or elapsed < best:
+                    best = elapsed
+            timings.append(best)
+    finally:
+        if gcenabled:
+            gc.enable()
+    if tracemalloc is not None and not tracemalloc.is_tracing():
+        for factor, data in zip(factors, inputs):
+            tracemalloc.start()
+            try:
+                func(data)
+                peaks.append(tracemalloc.get_traced_memory()[1] / factor)
+            finally:
+                tracemalloc.stop()
+
+    def linear(measured):
+        # measured per amount of input
+        return not measured or measured[-1] <= 3 * measured[0]
+
+    return linear(timings) and linear(peaks)
+
+
+# -- Command line interface --------------------------------------------
+
+
+_mbox_quote = re.compile(b'^(>*From )', re.MULTILINE).sub
+_mbox_unquote = re.compile(b'^>(>*From )', re.MULTILINE).sub
+_nonascii_search = re.compile(b'[\\x80-\\xff]').search
+
+
+def _mboxMessages(data):
+    """Split an mbox file into (fromline, message) bytestring pairs
+
+    data can be any bytes-like object supporting find and slicing, such as a
+    memory-mapped file. Messages are sliced off one at a time:
+
+        >>> mbox = (b'From alice Sat Jan  1 00:00:00 2000\\n'
+        ...         b'Subject: tea\\n\\nMore tea?\\n>From the Hare\\n\\n'
+        ...         b'From hare Sat Jan  1 00:01:00 2000\\n'
+        ...         b'Subject: Re: tea\\n\\nNo room!\\n')
+        >>> list(_mboxMessages(mbox)) == [
+        ...     (b'From alice Sat Jan  1 00:00:00 2000',
+        ...      b'Subject: tea\\n\\nMore tea?\\n>From the Hare\\n\\n'),
+        ...     (b'From hare Sat Jan  1 00:01:00 2000',
+        ...      b'Subject: Re: tea\\n\\nNo room!\\n')]
+        True
+
+    """
+    if data[:5] != b'From ':
+        raise ValueError('Not an mbox file')
+    start, size = 0, len(data)
+    while start < size:
+        end = data.find(b'\nFrom ', start)
+        end = size if end < 0 else end + 1
+        newline = data.find(b'\n', start, end)
+        if newline < 0:
+            newline = end
+        yield data[start:newline].rstrip(b'\r'), data[newline + 1:end]
+        start = end
+
+
+def _inputMessages(paths):
+    """Generate messages from mbox files and maildir trees
+
+    Yields (fromline, message, quoted) tuples, where quoted is True for
+    messages taken from an mbox file, with From lines in the body quoted.
+    Files are memory-mapped rather than read; messages in maildir folders
+    (the files in any directory named cur or new) get a generated From line.
+
+    """
+    import mmap
+    import os
+    import stat
+    import time
+
+    def mapped(path):
+        with open(path, 'rb') as f:
+            info = os.fstat(f.fileno())
+            if not (stat.S_ISREG(info.st_mode) and info.st_size):
+                # pipes and empty files can't be mapped
+                return f.read()
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    for path in paths:
+        if not os.path.isdir(path):
+            data = mapped(path)
+            if data:
+                try:
+                    for fromline, message in _mboxMessages(data):
+                        yield fromline, message, True
+                except ValueError as e:
+                    raise ValueError('%s: %s' % (path, e))
+            continue
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            if os.path.basename(dirpath) not in ('cur', 'new'):
+                continue
+            for filename in sorted(filenames):
+                filename = os.path.join(dirpath, filename)
+                fromline = 'From MAILER-DAEMON %s' % time.asctime(
+                    time.gmtime(os.path.getmtime(filename)))
+                data = mapped(filename)
+                yield fromline.encode('ascii'), data[:], False
+
+
+def _convertMessage(settings, item):
+    """Convert the text/plain parts of a message, for the command line
+
+    settings is a (mode, width, quote, delsp) tuple, where mode is one of
+    'wrapped', 'flowed' or 'reflow', and item a (fromline, message, quoted)
+    tuple as produced by _inputMessages. Returns (fromline, message,
+    converted, size, error), where the message is quoted for inclusion in an
+    mbox file (mboxrd style), converted counts the parts converted, size is
+    the input message size and error describes why the message could not be
+    converted, if it could not:
+
+        >>> message = (b'Content-Type: text/plain; format=flowed\\n\\n'
+        ...            b'> Take some more \\n> tea.\\n>From the Hare\\n')
+        >>> fromline, result, converted, size, error = _convertMessage(
+        ...     ('wrapped', 78, '>', False), (b'From alice', message, True))
+        >>> converted, size == len(message), error
+        (1, True, None)
+        >>> result.split(b'\\n\\n', 1)[1] == (
+        ...     b'> Take some more tea.\\n>From the Hare\\n')
+        True
+
+    Messages without parts to convert are returned unchanged:
+
+        >>> _convertMessage(('reflow', 78, '>', False),
+        ...                 (b'From alice', result, True))[1:3] == (result, 0)
+        True
+
+    Reflowing rewraps the text to the new width:
+
+        >>> message = (b'Content-Type: text/plain; format=flowed\\n\\n'
+        ...            b'Take some more tea, the March Hare \\n'
+        ...            b'said to Alice, very earnestly.\\n')
+        >>> result = _convertMessage(('reflow', 60, '>', False),
+        ...                          (b'From alice', message, False))[1]
+        >>> result.split(b'\\n\\n', 1)[1].split(b'\\n') == [
+        ...     b'Take some more tea, the March Hare said to Alice, very ',
+        ...     b'earnestly.', b'']
+        True
+
+    Parts keep their transfer encoding, and only their Content-Type
+    parameters change:
+
+        >>> message = (b'MIME-Version: 1.0\\n'
+        ...            b'Content-Type: multipart/mixed; boundary="b"\\n\\n'
+        ...            b'--b\\nContent-Type: text/plain; charset=utf-8\\n'
+        ...            b'Content-Transfer-Encoding: 8bit\\n\\n'
+        ...            b'Caf\\xc3\\xa9 au lait\\n--b--\\n')
+        >>> result = _convertMessage(('flowed', 78, '>', False),
+        ...                          (b'From alice', message, False))[1]
+        >>> result.split(b'\\n--b')[1].split(b'\\n') == [
+        ...     b'',
+        ...     b'Content-Type: text/plain; charset=utf-8; format="flowed"; '
+        ...     b'delsp="no"',
+        ...     b'Content-Transfer-Encoding: 8bit', b'',
+        ...     b'Caf\\xc3\\xa9 au lait']
+        True
+
+    Plain text is converted line by line, flowing long lines only; only '>'
+    marks quotes:
+
+        >>> message = (b'Content-Type: text/plain\\n\\n'
+        ...            b'> Take some more tea\\nFrom the Hare\\n'
+        ...            b'| col |\\n% percent\\n')
+        >>> result = _convertMessage(('flowed', 12, '>', False),
+        ...                          (b'From alice', message, False))[1]
+        >>> result.split(b'\\n\\n', 1)[1].split(b'\\n') == [
+        ...     b'> Take some ', b'> more tea', b' From the ', b'Hare',
+        ...     b'| col |', b'% percent', b'']
+        True
+
+    Messages that fail to convert are returned unchanged, with the error:
+
+        >>> message = (b'Content-Type: text/plain; format=flowed\\n\\n'
+        ...            b'>>>> Take some \\n>>>> more tea\\n')
+        >>> result = _convertMessage(('reflow', 4, '>', False),
+        ...                          (b'From alice', message, False))
+        >>> result[1:4] == (message, 0, len(message))
+        True
+        >>> print(result[4])
+        ValueError: Not enough width for both quoting and text
+
+    """
+    fromline, data, quoted = item
+    try:
+        result, converted = _convertParts(settings, data, quoted)
+    except Exception as e:
+        # pass the message through as it is
+        if not quoted:
+            data = _mbox_quote(b'>\\1', data)
+        return fromline, data, 0, len(item[1]), '%s: %s' % (
+            type(e).__name__, e)
+    return fromline, result, converted, len(data), None
+
+
+def _convertParts(settings, data, quoted):
+    """Convert the parts of a message, see _convertMessage"""
+    import email
+    import email.base64mime
+    import email.generator
+    import email.message
+    import io
+    import quopri
+
+    def setParams(part, params):
+        # set or, given None, remove Content-Type parameters in place
+        header = email.message.Message()
+        header['Content-Type'] = part.get('Content-Type', 'text/plain')
+        for name, value in params:
+            if value is None:
+                header.del_param(name)
+            else:
+                header.set_param(name, value)
+        if 'Content-Type' in part:
+            part.replace_header('Content-Type', header['Content-Type'])
+        else:
+            part['Content-Type'] = header['Content-Type']
+
+    mode, width, quote, delsp = settings
+    if quoted:
+        data = _mbox_unquote(b'\\1', data)
+    # Python 2 has no bytes specific parser and generator
+    message = getattr(email, 'message_from_bytes',
+                      email.message_from_string)(data)
+    converted = 0
+    for part in message.walk():
+        if part.get_content_type() != 'text/plain':
+            continue
+        isflowed = (part.get_param('format') or '').lower() == 'flowed'
+        if isflowed != (mode != 'flowed'):
+            continue
+        character_set = part.get_content_charset('us-ascii')
+        try:
+            codecs.lookup(character_set)
+        except LookupError:
+            continue
+        payload = part.get_payload(decode=True)
+        if payload is None:
+            continue
+        # Mailbox lines end in LF, format=flowed lines in CRLF. The payload's
+        # last line break is put back after converting, which ends the last
+        # line whether the payload did or not.
+        payload = payload.replace(b'\r\n', b'\n')
+        newline = b'\n' if payload.endswith(b'\n') else b''
+        payload = payload[:len(payload) - len(newline)].replace(b'\n', b'\r\n')
+        decoder_options = DecoderOptions(
+            (part.get_param('delsp') or '').lower() == 'yes', character_set,
+            'replace', coalesce_fixed=True)
+        encoder_options = EncoderOptions(delsp, character_set, 'replace',
+                                         width=width)
+        if mode == 'wrapped':
+            text = convertToWrapped(payload, width, quote,
+                                    options=decoder_options)
+            body = text.encode(character_set, 'replace')
+            setParams(part, [('format', None), ('delsp', None)])
+        else:
+            if mode == 'flowed':
+                # encode line by line; convertToFlowed would join the lines.
+                # Only '>' marks quotes in mail, '|' and '%' start text.
+                text = payload.decode(character_set, 'replace')
+                encoder = FormatFlowedEncoder(options=encoder_options)
+                blank = ({'type': FIXED, 'quotedepth': 0}, '')
+                body = encoder.encode(
+                    chunk for line in text.splitlines()
+                    for chunk in list(_parseFlowableChunks(
+                        line, quotechars='>')) or [blank])
+            else:
+                body = reflow(payload, decoder_options, encoder_options)
+            setParams(part, [('format', 'flowed'),
+                             ('delsp', 'yes' if delsp else 'no')])
+        body = body.replace(b'\r\n', b'\n')
+        if body.endswith(b'\n'):
+            body = body[:-1]
+        body += newline
+        # Keep the transfer encoding; set_payload with a character set
+        # would pick one for it, and add a MIME-Version header to subparts.
+        encoding = part.get('Content-Transfer-Encoding', '').strip().lower()
+        if encoding == 'base64':
+            body = email.base64mime.body_encode(
+                body.replace(b'\n', b'\r\n'), eol=str('\n'))
+        elif encoding == 'quoted-printable':
+            body = quopri.encodestring(body)
+        elif encoding not in ('8bit', 'binary') and _nonascii_search(body):
+            del part['Content-Transfer-Encoding']
+            part['Content-Transfer-Encoding'] = '8bit'
+        part.set_payload(body)
+        converted += 1
+
+    if converted:
+        out = io.BytesIO()
+        generator = getattr(email.generator, 'BytesGenerator',
+                            email.generator.Generator)
+        generator(out, mangle_from_=False).flatten(message)
+        data = out.getvalue()
+    return _mbox_quote(b'>\\1', data), converted
+
+
+def _main(argv):
+    """Command line entry point, see python -m formatflowed --help"""
+    if not argv or argv == ['-v']:
+        # Run tests with python formatflowed.py
+        return _test('-v' in argv).failed and 1 or 0
+
+    import argparse
+    import functools
+    import multiprocessing
+    import sys
+    import time
+
+    parser = argparse.ArgumentParser(
+        prog='python -m formatflowed',
+        description='Convert the text/plain parts of the messages in mbox '
+                    'files or maildir trees, writing an mbox file.')
+    parser.add_argument(
+        'mode', nargs='?', choices=('wrapped', 'flowed', 'reflow'),
+        help='wrapped: format=flowed parts to wrapped plain text; flowed: '
+             'plain text parts to format=flowed; reflow: format=flowed parts '
+             'to format=flowed with a new width and DelSp setting')
+    parser.add_argument('inputs', nargs='*', metavar='PATH',
+                        help='mbox file or maildir directory')
+    parser.add_argument('-o', '--output', metavar='FILE',
+                        help='mbox file to write (default: standard output)')
+    parser.add_argument('-w', '--width', type=int, default=78,
+                        help='line width (default: %(default)s)')
+    parser.add_argument('--quote', default='>',
+                        help='quote marker for wrapped text '
+                             '(default: %(default)s)')
+    parser.add_argument('--delsp', action='store_true',
+                        help='generate DelSp=yes format=flowed text')
+    parser.add_argument('-j', '--jobs', type=int,
+                        default=multiprocessing.cpu_count(),
+                        help='number of worker processes; 1 converts in '
+                             'process (default: %(default)s)')
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help='do not report throughput on standard error')
+    parser.add_argument('--test', action='store_true',
+                        help='run the module doctests')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='verbose doctest output')
+    # allow options between the mode and the paths, where supported
+    args = getattr(parser, 'parse_intermixed_args', parser.parse_args)(argv)
+    if args.test:
+        return _test(args.verbose).failed and 1 or 0
+    if args.mode is None or not args.inputs:
+        parser.error('a mode and at least one PATH are required')
+
+    convert = functools.partial(
+        _convertMessage, (args.mode, args.width, args.quote, args.delsp))
+    errors = []
+
+    def inputs():
+        # Stop at an input that is not an mbox file; exceptions raised while
+        # a pool reads the inputs are not passed on by older Pythons.
+        try:
+            for item in _inputMessages(args.inputs):
+                yield item
+        except ValueError as e:
+            errors.append(e)
+
+    pool = None
+    if args.jobs > 1:
+        pool = multiprocessing.Pool(args.jobs)
+        results = pool.imap(convert, inputs(), 16)
+    else:
+        results = (convert(item) for item in inputs())
+
+    if args.output:
+        output = open(args.output, 'wb')
+    else:
+        output = getattr(sys.stdout, 'buffer', sys.stdout)
+    started = time.time()
+    messages = parts = size = failed = 0
+    try:
+        for fromline, data, converted, insize, error in results:
+            if not data.endswith(b'\n'):
+                data += b'\n'
+            if not data.endswith(b'\n\n'):
+                data += b'\n'
+            output.write(fromline + b'\n')
+            output.write(data)
+            messages += 1
+            parts += converted
+            size += insize
+            if error is not None:
+                sys.stderr.write('%s: message %d left unchanged: %s\n' % (
+                    parser.prog, messages, error))
+                failed += 1
+    finally:
+        if pool is not None:
+            pool.terminate()
+        if args.output:
+            output.close()
+        else:
+            output.flush()
+    if errors:
+        sys.stderr.write('%s: error: %s\n' % (parser.prog, errors[0]))
+        return 1
+    elapsed = time.time() - started
+    if not args.quiet:
+        sys.stderr.write(
+            '%d messages, %d parts converted, %.1f MB in %.2f seconds '
+            '(%.1f MB/s)\n' % (messages, parts, size / 1e6, elapsed,
+                               size / 1e6 / (elapsed or 1e-9)))
+    return failed and 1 or 0
 
 
 def additional_tests():
@@ -923,6 +3728,5 @@ def _test(verbose=False):
 
 
 if __name__ == '__main__':
-    # Run tests with python formatflowed.py
     import sys
-    _test('-v' in sys.argv)
+    sys.exit(_main(sys.argv[1:]))